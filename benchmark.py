@@ -0,0 +1,415 @@
+import argparse
+import glob
+import json
+import platform
+import resource
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+import config
+import draw_lanes
+import histogram_img_search
+import lane_model
+import main
+import persp_transform
+import thresholds
+from main import Pipeline
+
+
+# Reproducible benchmarks for each stage module and the whole Pipeline, over
+# test_images/ and a synthetic lane video generated at several resolutions.
+# A fresh Pipeline per frame measures the cold full search; on the synthetic
+# videos one Pipeline also runs over the frames in order, which measures the
+# steady state of a video (look-ahead frames) and its lane fits in each mode.
+
+def synthetic_frames(w, h, n, seed=0):
+    """
+    Synthetic road video: two curved lanes (solid yellow left, dashed white
+    right) drawn in the birds-eye view and warped back to the camera view
+    :param w:
+    :param h:
+    :param n: number of frames
+    :param seed:
+    :return: list of RGB frames
+    """
+    rng = np.random.RandomState(seed)
+    _, inv_matrix = persp_transform.get_perspective_matrices(w, h)
+    y = np.arange(h, dtype=np.float64)
+    frames = []
+    for i in range(n):
+        birdseye = np.full((h, w, 3), 90, dtype=np.uint8)
+        bend = 0.25 * w * np.sin(i / 15.) * ((h - y) / h) ** 2
+        for x0, color, dashed in ((0.28 * w, (230, 200, 30), False), (0.72 * w, (240, 240, 240), True)):
+            x = x0 + bend
+            pts = np.int32(np.dstack((x, y))[0])
+            for j in range(0, h - 1, 2):
+                if dashed and (j + 4 * i) % (h // 6) > h // 12:
+                    continue
+                cv2.line(birdseye, tuple(pts[j]), tuple(pts[j + 1]), color, max(w // 100, 2))
+        frame = cv2.warpPerspective(birdseye, inv_matrix, (w, h), borderValue=(90, 90, 90))
+        noise = rng.randint(-12, 13, frame.shape)
+        frames.append(np.clip(frame.astype(np.int16) + noise, 0, 255).astype(np.uint8))
+    return frames
+
+
+def test_image_frames(pattern='test_images/*.jpg'):
+    return [cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB) for path in sorted(glob.glob(pattern))]
+
+
+def time_calls(fn, inputs, repeat):
+    """
+    Run fn over every input, repeat times
+    :param fn:
+    :param inputs:
+    :param repeat:
+    :return: dict of per-call latency, throughput and peak traced memory
+    """
+    fn(inputs[0])
+    latencies = []
+    for _ in range(repeat):
+        for item in inputs:
+            start = time.perf_counter()
+            fn(item)
+            latencies.append(time.perf_counter() - start)
+    return _summary(latencies, _peak_memory(fn, inputs[0]))
+
+
+def time_sequence(pipeline, frames, repeat):
+    """
+    One Pipeline over the frames in order, repeat times with a reset() in
+    between: every frame after the first tracks the lanes of the one before
+    :param pipeline:
+    :param frames: consecutive frames of a video
+    :param repeat:
+    :return: dict of per-frame latency, throughput and peak traced memory, see time_calls
+    """
+    # Builds the tables, which a video only pays for once
+    pipeline.main(frames[0])
+    latencies = []
+    for _ in range(repeat):
+        pipeline.reset()
+        for frame in frames:
+            start = time.perf_counter()
+            pipeline.main(frame)
+            latencies.append(time.perf_counter() - start)
+    return _summary(latencies, _peak_memory(pipeline.main, frames[0]))
+
+
+def _peak_memory(fn, item):
+    tracemalloc.start()
+    fn(item)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def _summary(latencies, peak):
+    latencies = np.array(latencies) * 1000
+    return {'calls': len(latencies),
+            'mean_ms': float(latencies.mean()),
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p95_ms': float(np.percentile(latencies, 95)),
+            'calls_per_s': float(1000 / latencies.mean()),
+            'peak_mb': peak / 2. ** 20}
+
+
+def stage_benchmarks(frames):
+    """
+    Benchmarks for every stage on one set of same sized frames
+    :param frames:
+    :return: dict of name -> function of a single input, and the inputs
+    """
+    h, w = frames[0].shape[:2]
+    geometry = persp_transform.get_geometry(w, h)
+    undistorted = [geometry.undistort(f) for f in frames]
+    warped = [geometry.undistort_and_warp(f) for f in frames]
+    masks = [thresholds.pipeline(f).copy() for f in warped]
+    found = [histogram_img_search.get_window_for_lane(m) for m in masks]
+    fits = [tuple(lane_model.fit_batch([f[2], f[4]], [f[1], f[3]])) for f in found]
+    pixels = [([f[2], f[4]], [f[1], f[3]]) for f in found]
+    drawing = [(m, u, f[1], f[2], f[3], f[4]) for m, u, f in zip(masks, undistorted, found)]
+
+    def pipeline_cold(frame):
+        Pipeline().main(frame)
+
+    return [
+        ('persp_transform.undistort_and_warp', geometry.undistort_and_warp, frames),
+        ('persp_transform.get_warped_perspective', persp_transform.get_warped_perspective, undistorted),
+        ('thresholds.pipeline', thresholds.pipeline, warped),
+        ('thresholds.reference_pipeline', thresholds.reference_pipeline, warped),
+        ('histogram_img_search.get_window_for_lane', histogram_img_search.get_window_for_lane, masks),
+        ('lane_model.fit_batch', lambda args: lane_model.fit_batch(*args), pixels),
+        ('np.polyfit (reference)', lambda args: [np.polyfit(y, x, 2) for y, x in zip(*args)], pixels),
+        ('histogram_img_search.search_around_poly',
+         lambda args: histogram_img_search.search_around_poly(*args), list(zip(masks, *zip(*fits)))),
+        ('draw_lanes.draw_on_orig', lambda args: draw_lanes.draw_on_orig(*args, geometry=geometry), drawing),
+        ('draw_lanes.lane_polygon + draw_polygon',
+         lambda args: draw_lanes.draw_polygon(args[0], draw_lanes.lane_polygon(args[1][0], args[1][1], geometry)),
+         list(zip(undistorted, fits))),
+        ('Pipeline.main cold', pipeline_cold, frames),
+    ]
+
+
+def sequence_benchmarks():
+    """
+    Pipelines timed over a whole video with time_sequence, one per mode
+    :return: list of (name, Pipeline)
+    """
+    scale = config.benchmark_configs['mode_detection_scale']
+    return [('Pipeline.main sequence', Pipeline()),
+            ('Pipeline.main sequence detection_scale={0}'.format(scale), Pipeline(detection_scale=scale)),
+            ('Pipeline.main sequence skip_static', Pipeline(skip_static=True))]
+
+
+def lane_fits(frame, reference=False):
+    """
+    Pixel-space lane fits through the optimized or the reference path
+    :param frame:
+    :param reference: cv2.undistort + warpPerspective + float64 thresholds
+    :return: (left_fit, right_fit), whether the search passed is_confident
+    """
+    h, w = frame.shape[:2]
+    if reference:
+        undistorted = cv2.undistort(frame, config.mtx, config.dist, None, config.mtx)
+        mask = thresholds.reference_pipeline(persp_transform.get_warped_perspective(undistorted))
+        found = histogram_img_search.get_window_for_lane(mask)
+        fits = np.polyfit(found[2], found[1], 2), np.polyfit(found[4], found[3], 2)
+    else:
+        mask = thresholds.pipeline(persp_transform.get_geometry(w, h).undistort_and_warp(frame))
+        found = histogram_img_search.get_window_for_lane(mask, curvature=False)
+        fits = tuple(lane_model.fit_batch([found[2], found[4]], [found[1], found[3]]))
+    return fits, histogram_img_search.is_confident(found[1], found[3], found[5], found[6])
+
+
+def reference_search(mask, prior=None):
+    """
+    Lane fits of the reference search: the sliding windows, or the pixels
+    within lookahead_margin of prior fits, fitted with np.polyfit
+    :param mask: birds-eye view from thresholds.reference_pipeline
+    :param prior: pixel-space (left_fit, right_fit) to search around, None for the sliding windows
+    :return: (left_fit, right_fit), whether the search passed is_confident
+    """
+    if prior is None:
+        found = histogram_img_search.get_window_for_lane(mask)
+    else:
+        found, _ = histogram_img_search.lookahead_search(mask, prior[0], prior[1])
+    leftx, lefty, rightx, righty = found[1:5]
+    if len(lefty) < 3 or len(righty) < 3:
+        return None, False
+    fits = np.polyfit(lefty, leftx, 2), np.polyfit(righty, rightx, 2)
+    # The look-ahead checks the width where its own fits reach the bottom, see lookahead_search
+    bottom = mask.shape[0] - 1
+    leftx_base, rightx_base = found[5:7] if prior is None else \
+        (int(np.polyval(fits[0], bottom)), int(np.polyval(fits[1], bottom)))
+    return fits, histogram_img_search.is_confident(leftx, rightx, leftx_base, rightx_base)
+
+
+def fit_diff(fits, ref_fits, h):
+    """
+    :return: largest difference in x (pixels) between two pairs of fits over the bottom half of the frame
+    """
+    y = np.arange(h // 2, h)
+    return max(float(np.max(np.abs(np.polyval(fit, y) - np.polyval(ref, y)))) for fit, ref in zip(fits, ref_fits))
+
+
+def check_fits(frames, tolerance=None, remap_tolerance=None):
+    """
+    Optimized against reference path on every frame:
+    - the ThresholdEngine mask of a birds-eye view must equal reference_pipeline's
+    - on that same birds-eye view, the sliding window search with lane_model
+      fits must be within tolerance of the reference search with np.polyfit
+    - end to end, the composed undistort+warp remap interpolates once where
+      cv2.undistort + warpPerspective interpolate twice, which alone moves the
+      fits by several pixels, so that comparison has its own remap_tolerance
+    Fits are only compared on frames the reference search is confident on.
+    Frames it is not confident on (the windows settled on noise) have no right
+    answer, they are counted as unchecked.
+    :param frames:
+    :param tolerance: x pixels over the bottom half of the frame
+    :param remap_tolerance:
+    :return: dict of the mask pixels that differ, median and max fit difference on the same
+             birds-eye view, max end to end difference, frames checked and whether it passed
+    """
+    tolerance = tolerance or config.benchmark_configs['fit_tolerance_px']
+    remap_tolerance = remap_tolerance or config.benchmark_configs['remap_tolerance_px']
+    h, w = frames[0].shape[:2]
+    geometry = persp_transform.get_geometry(w, h)
+    mask_diff = 0
+    diffs = []
+    remap_diffs = []
+    for frame in frames:
+        warped = geometry.undistort_and_warp(frame)
+        mask = thresholds.pipeline(warped)
+        reference_mask = thresholds.reference_pipeline(warped)
+        mask_diff += int(np.count_nonzero(mask != reference_mask))
+        ref_fits, confident = reference_search(reference_mask)
+        if confident:
+            found = histogram_img_search.get_window_for_lane(mask, curvature=False)
+            fits = tuple(lane_model.fit_batch([found[2], found[4]], [found[1], found[3]]))
+            diffs.append(fit_diff(fits, ref_fits, h))
+        end_to_end_fits, confident = lane_fits(frame, reference=True)
+        if confident:
+            remap_diffs.append(fit_diff(lane_fits(frame)[0], end_to_end_fits, h))
+    max_diff = max(diffs) if diffs else 0.
+    remap_diff = max(remap_diffs) if remap_diffs else 0.
+    return {'mask_diff_px': mask_diff,
+            'median_diff_px': float(np.median(diffs)) if diffs else 0.,
+            'max_diff_px': max_diff,
+            'remap_diff_px': remap_diff,
+            'checked': len(diffs),
+            'unchecked': len(frames) - len(diffs),
+            'ok': mask_diff == 0 and max_diff <= tolerance and remap_diff <= remap_tolerance}
+
+
+def check_modes(frames, tolerance=None):
+    """
+    The lane fits a Pipeline tracks over a video, one Pipeline per mode, against
+    the reference search on the same birds-eye view of every frame: the sliding
+    windows while the Pipeline has no fits to track, after that the look-ahead
+    around the Pipeline's prior fits. Modes:
+    - lookahead: the default Pipeline, every frame after the first is a look-ahead
+    - detection_scale: searches a mode_detection_scale birds-eye view, the
+      tolerance is in pixels of that view so it is divided by the scale
+    - skip_static: every frame is shown twice, a skipped frame keeps the fits
+      of the frame it repeats, which must still fit this frame
+    Frames the Pipeline did not trust or the reference is not confident on are unchecked.
+    :param frames: consecutive frames of a video
+    :param tolerance: x pixels over the bottom half of the frame
+    :return: dict of mode -> dict of median and max fit difference, frames checked,
+             frames that ran the mode (look-ahead or skipped) and whether it passed
+    """
+    tolerance = tolerance or config.benchmark_configs['fit_tolerance_px']
+    scale = config.benchmark_configs['mode_detection_scale']
+    h, w = frames[0].shape[:2]
+    geometry = persp_transform.get_geometry(w, h)
+    cases = [('lookahead', Pipeline(render=False), frames, 1.0),
+             ('detection_scale', Pipeline(render=False, detection_scale=scale), frames, scale),
+             ('skip_static', Pipeline(render=False, skip_static=True), [f for f in frames for _ in range(2)], 1.0)]
+    report = {}
+    for name, pipeline, sequence, case_scale in cases:
+        diffs = []
+        exercised = 0
+        for frame in sequence:
+            prior = pipeline.tracked_fits()
+            pipeline.main(frame)
+            skipped = pipeline.last_result['mode'] == main.SKIP
+            exercised += skipped if name == 'skip_static' else prior is not None
+            if not (pipeline.last_trusted or skipped) or pipeline.left_fit is None:
+                continue
+            ref_fits, confident = reference_search(
+                thresholds.reference_pipeline(geometry.undistort_and_warp(frame)), prior)
+            if confident:
+                diffs.append(fit_diff((pipeline.left_fit, pipeline.right_fit), ref_fits, h))
+        max_diff = max(diffs) if diffs else 0.
+        report[name] = {'median_diff_px': float(np.median(diffs)) if diffs else 0.,
+                        'max_diff_px': max_diff,
+                        'checked': len(diffs),
+                        'exercised': int(exercised),
+                        'ok': bool(diffs) and exercised > 0 and max_diff <= tolerance / case_scale}
+    return report
+
+
+def run(repeat=None, resolutions=None, n_frames=None):
+    """
+    :param repeat:
+    :param resolutions:
+    :param n_frames:
+    :return: report dict
+    """
+    repeat = repeat or config.benchmark_configs['repeat']
+    resolutions = resolutions or config.benchmark_configs['resolutions']
+    n_frames = n_frames or config.benchmark_configs['synthetic_frames']
+    datasets = [('test_images', test_image_frames())]
+    for w, h in resolutions:
+        datasets.append(('synthetic_{0}x{1}'.format(w, h), synthetic_frames(w, h, n_frames)))
+
+    report = {'platform': platform.platform(), 'opencv': cv2.__version__, 'numpy': np.__version__,
+              'results': {}, 'fits': {}, 'modes': {}}
+    for name, frames in datasets:
+        # test_images are unrelated stills, only the synthetic frames are a video
+        video = name.startswith('synthetic')
+        for stage, fn, inputs in stage_benchmarks(frames):
+            report['results']['{0}/{1}'.format(name, stage)] = time_calls(fn, inputs, repeat)
+        if video:
+            for stage, pipeline in sequence_benchmarks():
+                report['results']['{0}/{1}'.format(name, stage)] = time_sequence(pipeline, frames, repeat)
+        # config.mtx/dist only describe the camera at its calibrated size
+        if frames[0].shape[1::-1] == config.calibration_size:
+            report['fits'][name] = check_fits(frames)
+            if video:
+                report['modes'][name] = check_modes(frames)
+    report['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    return report
+
+
+def compare(report, baseline, ratio=None):
+    """
+    Per benchmark slowdown against a stored baseline
+    :param report:
+    :param baseline:
+    :param ratio: slowdown that counts as a regression
+    :return: list of (name, baseline ms, current ms, slowdown, regressed)
+    """
+    ratio = ratio or config.benchmark_configs['regression_ratio']
+    rows = []
+    for name, result in sorted(report['results'].items()):
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        slowdown = result['mean_ms'] / base['mean_ms']
+        rows.append((name, base['mean_ms'], result['mean_ms'], slowdown, slowdown > ratio))
+    return rows
+
+
+def print_report(report, comparison=None):
+    print('{0:<75} {1:>9} {2:>9} {3:>9} {4:>9}'.format('benchmark', 'mean ms', 'p95 ms', 'calls/s', 'peak MB'))
+    for name, r in sorted(report['results'].items()):
+        print('{0:<75} {1:>9.2f} {2:>9.2f} {3:>9.1f} {4:>9.1f}'.format(
+            name, r['mean_ms'], r['p95_ms'], r['calls_per_s'], r['peak_mb']))
+    for name, fit in sorted(report['fits'].items()):
+        print('fits {0}: {1} mask pixels differ, median diff {2:.2f}px, max diff {3:.2f}px over {4} frames '
+              '({5} unchecked), end to end max diff {6:.2f}px {7}'.format(
+                  name, fit['mask_diff_px'], fit['median_diff_px'], fit['max_diff_px'], fit['checked'],
+                  fit['unchecked'], fit['remap_diff_px'], 'OK' if fit['ok'] else 'FAIL'))
+    for name, modes in sorted(report['modes'].items()):
+        for mode, fit in sorted(modes.items()):
+            print('fits {0} {1}: median diff {2:.2f}px, max diff {3:.2f}px over {4} frames ({5} in mode) {6}'.format(
+                name, mode, fit['median_diff_px'], fit['max_diff_px'], fit['checked'], fit['exercised'],
+                'OK' if fit['ok'] else 'FAIL'))
+    if comparison:
+        for name, base, current, slowdown, regressed in comparison:
+            if regressed:
+                print('REGRESSION {0}: {1:.2f}ms -> {2:.2f}ms ({3:.2f}x)'.format(name, base, current, slowdown))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the lane finding stages and Pipeline')
+    parser.add_argument('--repeat', type=int, default=None)
+    parser.add_argument('--frames', type=int, default=None, help='synthetic frames per resolution')
+    parser.add_argument('--baseline', default=config.benchmark_configs['baseline'])
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--output', help='write the full report as JSON')
+    args = parser.parse_args()
+
+    report = run(repeat=args.repeat, n_frames=args.frames)
+    comparison = None
+    if not args.save_baseline:
+        try:
+            with open(args.baseline) as f:
+                comparison = compare(report, json.load(f))
+        except IOError:
+            pass
+    print_report(report, comparison)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+    failed = not all(fit['ok'] for fit in report['fits'].values()) or \
+        not all(fit['ok'] for modes in report['modes'].values() for fit in modes.values())
+    regressed = comparison and any(row[4] for row in comparison)
+    raise SystemExit(1 if failed or regressed else 0)
@@ -1,4 +1,6 @@
 import glob
+import hashlib
+import multiprocessing
 import os
 
 import cv2
@@ -8,44 +10,48 @@ import config
 
 
 class Calibrate(object):
-    def __init__(self, save_images=True, plot_images=True):
+    def __init__(self, save_images=True, plot_images=True, processes=None):
         """
         Class for calibrating a camera to get rid of distortions
         :param save_images:
+        :param plot_images:
+        :param processes: corner detection processes, defaults to the number of cores
         """
         self.save_images = save_images
         self.path = config.calibrate_path
         self.output = config.calibrate_output
-        self.img_paths = glob.glob(self.path)
+        self.img_paths = sorted(glob.glob(self.path))
         self.plot_images = plot_images
+        self.processes = processes or config.calibrate_configs['processes'] or multiprocessing.cpu_count()
 
     def calibrate(self):
         """
-        Main function to run the entire process
+        Main function to run the entire process.
+        Corners are found in parallel and cached per image, so adding an
+        image only runs detection on that image. The result is saved to
+        config.calibrate_configs['calibration_file'] for load_calibration,
+        with the hashes of the images it was computed from.
         :return:
         """
         if not os.path.exists(self.output):
             os.mkdir(self.output)
-        objpoints = []
-        imgpoints = []
+        # Before the workers start, so they never race to create it
+        if not os.path.exists(config.calibrate_configs['corner_cache']):
+            os.makedirs(config.calibrate_configs['corner_cache'])
+        args = [(img_path, self.output, self.save_images) for img_path in self.img_paths]
+        if self.processes > 1 and len(args) > 1:
+            with multiprocessing.Pool(min(self.processes, len(args))) as pool:
+                found = pool.map(_find_image_corners, args)
+        else:
+            found = [_find_image_corners(a) for a in args]
         # Get the corners of all the  calibration images
-        for img_path in self.img_paths:
-            print(img_path)
-            fname = os.path.basename(img_path)
-            img = cv2.imread(img_path)
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            ret, objp, corners, nx, ny = self.find_chess_corners(gray)
-            if ret:
-                objpoints.append(objp)
-                imgpoints.append(corners)
-                write_path = os.path.join(self.output, fname)
-            else:
-                write_path = os.path.join(self.output, '{0}_fail.jpg'.format(fname.split('.')[0]))
-            if self.save_images:
-                self.draw_and_save(img, nx, ny, corners, ret, write_path=write_path)
+        objpoints = [f['objp'] for f in found if f['ret']]
+        imgpoints = [f['corners'] for f in found if f['ret']]
+        size = found[-1]['size']
         # Use cv2's calibrateCamera to calibrate all the given points
-        ret, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(objpoints, imgpoints, gray.shape[::-1], None, None)
+        ret, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(objpoints, imgpoints, size, None, None)
         print('MTX={0} \n DIST={1}'.format(mtx.tolist(), dist.tolist()))
+        save_calibration(mtx, dist, size, images=[f['key'] for f in found])
         if self.save_images:
             for img_path in self.img_paths:
                 fname = os.path.basename(img_path)
@@ -79,26 +85,148 @@ class Calibrate(object):
         :param gray:
         :return:
         """
-        for nx in range(9, 3, -1):
-            for ny in range(9, 3, -1):
+        for nx, ny in _pattern_sizes():
+            ret, corners = cv2.findChessboardCorners(gray, (nx, ny), None)
+            print('({0}, {1}), {2}'.format(nx, ny, ret))
+            if ret:
+                return _refine(gray, corners, nx, ny)
+        return False, None, None, None, None
+
+    @staticmethod
+    def find_chess_corners_fast(gray):
+        """
+        find_chess_corners with a downscaled pre-pass: the pattern size is
+        picked on a small copy of the image, then detected once at full
+        resolution. Falls back to the full search if that fails.
+        :param gray:
+        :return:
+        """
+        scale = config.calibrate_configs['prepass_scale']
+        small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        for nx, ny in _pattern_sizes():
+            if cv2.findChessboardCorners(small, (nx, ny), None, cv2.CALIB_CB_FAST_CHECK)[0]:
                 ret, corners = cv2.findChessboardCorners(gray, (nx, ny), None)
-                print('({0}, {1}), {2}'.format(nx, ny, ret))
                 if ret:
-                    objp = np.zeros((nx * ny, 3), np.float32)
-                    objp[:, :2] = np.mgrid[0:nx, 0:ny].T.reshape(-1, 2)
-                    # http://docs.opencv.org/2.4/doc/tutorials/features2d/trackingmotion/corner_subpixeles/corner_subpixeles.html
-                    # Use the OpenCV function cornerSubPix to find more exact corner positions.
-                    # edits corners in place
-                    cv2.cornerSubPix(gray, corners, winSize=config.win_size, zeroZone=config.zero_zone,
-                                     criteria=config.criteria)
-                    return ret, objp, corners, nx, ny
-        return False, None, None, None, None
+                    return _refine(gray, corners, nx, ny)
+                break
+        return Calibrate.find_chess_corners(gray)
 
     def draw_and_save(self, img, nx, ny, corners, ret, write_path):
         cv2.drawChessboardCorners(img, (nx, ny), corners, ret)
         cv2.imwrite(write_path, img)
 
 
+def _pattern_sizes():
+    for nx in range(9, 3, -1):
+        for ny in range(9, 3, -1):
+            yield nx, ny
+
+
+def _refine(gray, corners, nx, ny):
+    objp = np.zeros((nx * ny, 3), np.float32)
+    objp[:, :2] = np.mgrid[0:nx, 0:ny].T.reshape(-1, 2)
+    # http://docs.opencv.org/2.4/doc/tutorials/features2d/trackingmotion/corner_subpixeles/corner_subpixeles.html
+    # Use the OpenCV function cornerSubPix to find more exact corner positions.
+    # edits corners in place
+    cv2.cornerSubPix(gray, corners, winSize=config.win_size, zeroZone=config.zero_zone,
+                     criteria=config.criteria)
+    return True, objp, corners, nx, ny
+
+
+def _find_image_corners(args):
+    """
+    Worker: corners of one calibration image, read from disk once and
+    cached by the hash of its bytes
+    :param args: (img_path, output, save_images)
+    :return: dict of ret, objp, corners, size and the image's cache key
+    """
+    img_path, output, save_images = args
+    data = np.fromfile(img_path, dtype=np.uint8)
+    key = _corner_cache_key(data)
+    cache_path = os.path.join(config.calibrate_configs['corner_cache'], key + '.npz')
+    if os.path.exists(cache_path):
+        cached = np.load(cache_path)
+        ret = bool(cached['ret'])
+        return {'ret': ret, 'objp': cached['objp'] if ret else None, 'corners': cached['corners'] if ret else None,
+                'size': tuple(int(s) for s in cached['size']), 'key': key}
+    print(img_path)
+    img = cv2.imdecode(data, cv2.IMREAD_COLOR)
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    ret, objp, corners, nx, ny = Calibrate.find_chess_corners_fast(gray)
+    size = gray.shape[::-1]
+    if save_images:
+        fname = os.path.basename(img_path)
+        if ret:
+            write_path = os.path.join(output, fname)
+            cv2.drawChessboardCorners(img, (nx, ny), corners, ret)
+        else:
+            write_path = os.path.join(output, '{0}_fail.jpg'.format(fname.split('.')[0]))
+        cv2.imwrite(write_path, img)
+    os.makedirs(config.calibrate_configs['corner_cache'], exist_ok=True)
+    empty = np.zeros(0, np.float32)
+    np.savez(cache_path, ret=ret, objp=objp if ret else empty, corners=corners if ret else empty, size=size)
+    return {'ret': ret, 'objp': objp, 'corners': corners, 'size': size, 'key': key}
+
+
+def _corner_cache_key(data):
+    """
+    Hash of the image bytes plus the settings that change the corners
+    :param data:
+    :return:
+    """
+    h = hashlib.sha1(data.tobytes())
+    h.update(repr((config.calibrate_configs['version'], config.calibrate_configs['prepass_scale'],
+                   config.win_size, config.zero_zone, config.criteria)).encode())
+    return h.hexdigest()
+
+
+def image_keys(img_paths=None):
+    """
+    Corner cache keys of the calibration images, what a saved calibration was computed from
+    :param img_paths: defaults to the images of config.calibrate_path
+    :return: sorted list of keys
+    """
+    img_paths = sorted(glob.glob(config.calibrate_path)) if img_paths is None else img_paths
+    return sorted(_corner_cache_key(np.fromfile(img_path, dtype=np.uint8)) for img_path in img_paths)
+
+
+def save_calibration(mtx, dist, size, path=None, images=()):
+    """
+    Save a calibration for later runs, see load_calibration
+    :param mtx:
+    :param dist:
+    :param size: (width, height) of the calibration images
+    :param path:
+    :param images: corner cache keys of the images it was computed from, see image_keys
+    :return:
+    """
+    path = path or config.calibrate_configs['calibration_file']
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    np.savez(path, version=config.calibrate_configs['version'], mtx=mtx, dist=dist, size=size,
+             images=np.array(sorted(images), dtype=str))
+
+
+def load_calibration(path=None, img_paths=None):
+    """
+    Calibration saved by Calibrate.calibrate, as long as the calibration images are the ones it was computed from
+    :param path:
+    :param img_paths: calibration images, defaults to the images of config.calibrate_path
+    :return: mtx, dist or None when there is no file, it is from another version
+             or an image was added, removed or changed since
+    """
+    path = path or config.calibrate_configs['calibration_file']
+    if not os.path.exists(path):
+        return None
+    saved = np.load(path)
+    if int(saved['version']) != config.calibrate_configs['version']:
+        return None
+    if 'images' not in saved.files or saved['images'].tolist() != image_keys(img_paths):
+        return None
+    return saved['mtx'], saved['dist']
+
+
 if __name__ == '__main__':
     c = Calibrate()
     mtx, dist = c.calibrate()
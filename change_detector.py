@@ -0,0 +1,94 @@
+import cv2
+import numpy as np
+
+import config
+
+
+# Skip cache for static or near-duplicate frames (traffic jams, stops).
+# The signature of a frame is a tiny grey birds-eye view of the road: one
+# remap at signature_scale straight from the raw frame (the Geometry's composed
+# undistort + warp table), cropped to the road ROI and area averaged down to
+# signature_size, which also averages out sensor noise. A frame whose signature
+# differs from the last fully processed frame's by less than threshold in every
+# cell reuses that frame's lanes. It is the largest cell difference that counts,
+# not the mean, as a moving lane dash only changes a few cells. Comparing
+# against the last processed frame rather than the previous one means slow
+# drift still triggers detection, and after max_skips skipped frames in a row
+# detection runs regardless.
+
+
+class ChangeDetector(object):
+    def __init__(self, threshold=None, max_skips=None):
+        """
+        :param threshold: grey level difference of any signature cell below which a frame is a duplicate
+        :param max_skips: skipped frames in a row before a frame is processed anyway
+        """
+        self.threshold = config.skip_configs['threshold'] if threshold is None else threshold
+        self.max_skips = config.skip_configs['max_skips'] if max_skips is None else max_skips
+        self.keyframe = None
+        self._pending = None
+        self.streak = 0
+        self.checked = 0
+        self.skipped = 0
+        self.last_change = None
+
+    def signature(self, img, geometry):
+        """
+        :param img: raw RGB frame
+        :param geometry: persp_transform.Geometry of the frame
+        :return: (h, w) float32 signature
+        """
+        scale = config.skip_configs['signature_scale']
+        x0, y0, x1, y1 = geometry.scaled_roi(scale)
+        small = geometry.undistort_and_warp(img, scale=scale)[y0:y1, x0:x1]
+        grey = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY)
+        return cv2.resize(grey, tuple(config.skip_configs['signature_size']),
+                          interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    def check(self, img, geometry, reusable=True):
+        """
+        Whether img is close enough to the last processed frame to reuse its lanes.
+        Call keep() when the frame is processed after all.
+        :param img:
+        :param geometry:
+        :param reusable: False when there is nothing to reuse, the frame is then always processed
+        :return: True to skip detection
+        """
+        self.checked += 1
+        signature = self.signature(img, geometry)
+        if not reusable or self.keyframe is None or self.keyframe.shape != signature.shape or \
+                self.streak >= self.max_skips:
+            self.last_change = None
+            self._pending = signature
+            return False
+        self.last_change = float(cv2.norm(signature, self.keyframe, cv2.NORM_INF))
+        if self.last_change < self.threshold:
+            self.streak += 1
+            self.skipped += 1
+            return True
+        self._pending = signature
+        return False
+
+    def keep(self):
+        """
+        The checked frame was processed, it is the reference for the next frames
+        :return:
+        """
+        if self._pending is not None:
+            self.keyframe = self._pending
+            self._pending = None
+        self.streak = 0
+
+    def reset(self):
+        """Forget the reference frame, e.g. when the geometry changed"""
+        self.keyframe = None
+        self.streak = 0
+
+    def stats(self):
+        """
+        :return: dict of frames checked, skipped (cache hits) and the skip rate
+        """
+        return {'checked': self.checked,
+                'skipped': self.skipped,
+                'processed': self.checked - self.skipped,
+                'skip_rate': self.skipped / float(self.checked) if self.checked else 0.}
@@ -7,6 +7,14 @@ zero_zone = (-1, -1)
 criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 40, 0.001)
 calibrate_path = 'camera_cal/*'
 calibrate_output = 'camera_cal_final/'
+calibrate_configs = {'calibration_file': 'camera_cal_final/calibration.npz',
+                     # per image corners, keyed by a hash of the image file
+                     'corner_cache': 'camera_cal_final/corners/',
+                     # bump to invalidate saved calibrations and cached corners
+                     'version': 1,
+                     # downscale used to pick the chessboard size before the full resolution search
+                     'prepass_scale': 0.5,
+                     'processes': None}
 test_img = 'test_images/test1.jpg'
 mtx = np.array([[1161.4544214947468, 0.0, 663.6021039294545],
                 [0.0, 1158.838389558496, 389.1425902466672],
@@ -14,6 +22,8 @@ mtx = np.array([[1161.4544214947468, 0.0, 663.6021039294545],
 dist = np.array([[-0.2529169436992288, 0.03053774528012267,
                   -0.00023396495669634497, -0.00024374058563359847,
                   -0.10159488679195793]])
+# (width, height) of the images mtx and dist were computed from
+calibration_size = (1280, 720)
 
 # Perspective Transform Configs:
 perspect_configs = {'far_left': .37,
@@ -32,8 +42,139 @@ threshold_configs = {'sobel_min': 20,
 
 # Histogram Image Search Configs
 hist_configs = {'nwindows': 9,
+                # Sliding window half width and pixels needed to recenter the next window
+                'window_margin': 100,
+                'minpix': 50,
+                # Look-ahead search around the previous frame's fits
+                'lookahead_margin': 100,
+                'min_lane_pixels': 200,
+                'max_lookahead_failures': 5,
                 }
 
+# Detection Resolution Configs
+resolution_configs = {'scale': 1.0,
+                      # scales the adaptive controller moves between
+                      'scales': [1.0, 0.5, 0.25],
+                      'adaptive': False,
+                      'target_fps': 25,
+                      # frames observed before changing scale again
+                      'patience': 10,
+                      # only undistort the road region of the output frame
+                      'undistort_roi': False}
+
+# Real-time Configs
+realtime_configs = {'budget_ms': 40,
+                    # frames waiting to be processed before the oldest is dropped
+                    'max_queue': 2,
+                    # weight of the newest latency in the per-mode estimates
+                    'smoothing': 0.2,
+                    # reused frames in a row before detection runs regardless of the budget
+                    'max_reuse': 4,
+                    # frames dropped in a row before a full detection runs regardless of the budget
+                    'max_drops': 5}
+
+# Overlay Rendering Configs
+# 'fast' projects the lane polygon into camera space and blends its bounding box,
+# 'warp' draws in the birds-eye view and warps the full overlay back
+# 'render': False skips the overlay entirely, only the lane geometry is computed
+render_configs = {'mode': 'fast',
+                  'render': True}
+
+# Results Configs
+# rows buffered in memory before a bulk write to the results file
+results_configs = {'buffer_rows': 1024}
+
+# Lane Model Configs, see lane_model
+fit_configs = {# 'lsq', 'irls' (robust reweighting) or 'ransac'
+               'method': 'lsq',
+               'irls_iterations': 3,
+               # Tukey biweight cutoff, in residual scales
+               'irls_tuning': 4.685,
+               # lower bound on the residual scale so clean lanes are not over-trimmed
+               'min_scale_px': 2.,
+               'ransac_iterations': 50,
+               'ransac_threshold_px': 15,
+               'ransac_seed': 0}
+
+# Skip Cache Configs, see change_detector
+skip_configs = {'enabled': False,
+                # largest grey level difference between signature cells that still counts as the same frame
+                'threshold': 12,
+                # skipped frames in a row before detection runs anyway
+                'max_skips': 25,
+                # birds-eye scale of the signature remap, then area averaged down to signature_size (w, h)
+                'signature_scale': 0.25,
+                'signature_size': (32, 24)}
+
+# Temporal Lane State Configs
+history_configs = {'capacity': 256,
+                   # trusted fits averaged for drawing and the look-ahead search
+                   'smooth_frames': 5}
+
 # Video Config
 lane_configs = {'min_width': 400,
-              'max_width': 650}
\ No newline at end of file
+              'max_width': 650}
+
+# Parallel Video Configs
+parallel_configs = {'chunk_size': 48,
+                    # frames from the end of the previous chunk replayed to rebuild temporal lane state
+                    'warmup_frames': 12,
+                    # chunks in flight / waiting to be written, per worker process
+                    'pending_per_process': 2,
+                    # 'shm' keeps frames in a shared memory FrameRing, 'pickle' sends them to the workers
+                    'transport': 'shm',
+                    # FrameRing slots, None for enough to keep every worker busy
+                    'ring_slots': None}
+
+# Streaming Video Configs
+video_configs = {'fourcc': 'mp4v',
+                 'fps': 25,
+                 # frames buffered between decode, process and encode stages
+                 'queue_size': 8}
+
+# Config Reload Configs, see live_config
+reload_configs = {# seconds between checks of the watched config file
+                  'interval': 1.0,
+                  # values kept per memoized function before its cache is cleared
+                  'max_cache_entries': 8}
+
+# Profiling Configs
+profile_configs = {'window': 1000}
+
+# Benchmark Configs
+benchmark_configs = {'resolutions': [(640, 360), (1280, 720), (1920, 1080)],
+                     'synthetic_frames': 30,
+                     'repeat': 10,
+                     'baseline': 'benchmark_baseline.json',
+                     # a stage is a regression when it is this much slower than the baseline
+                     'regression_ratio': 1.25,
+                     # max difference in x (pixels) between optimized and reference lane fits on the
+                     # same birds-eye view, on any frame the reference search is confident on
+                     'fit_tolerance_px': 5,
+                     # the same end to end: the composed remap interpolates once instead of twice,
+                     # which moves confident synthetic fits by up to 9 pixels
+                     'remap_tolerance_px': 10,
+                     # detection_scale of the scaled Pipeline in the sequence benchmarks and fit checks
+                     'mode_detection_scale': 0.5}
+
+# Lane Server Configs
+server_configs = {'host': '127.0.0.1',
+                  'port': 8765,
+                  # frames read ahead per stream before the server stops reading its socket
+                  'queue_size': 4,
+                  # threads running Pipeline.main for all streams, None for one per core
+                  'workers': None}
+
+# Startup Configs, see fast_start
+startup_configs = {# directory of memory mapped remap tables shared by processes, None to always build them
+                   'geometry_cache': None,
+                   # bump to invalidate the saved remap tables
+                   'version': 1,
+                   # frame size fast_start builds the tables for before forking its workers
+                   'warm_size': (1280, 720)}
+
+# Frame Store Configs, see frame_store
+store_configs = {# frames written between rewrites of the .npy headers while a store is built
+                 'flush_frames': 100,
+                 # frames before the requested range replayed to rebuild temporal lane state
+                 'warmup_frames': 12}
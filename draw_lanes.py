@@ -1,13 +1,16 @@
 import cv2
 import numpy as np
 
+import lane_model
 import persp_transform
 
 
-def draw_on_orig(binary_warped, undistorted, leftx, lefty, rightx, righty):
-    # Fit a second order polynomial to each
-    left_fit = np.polyfit(lefty, leftx, 2)
-    right_fit = np.polyfit(righty, rightx, 2)
+def draw_on_orig(binary_warped, undistorted, leftx, lefty, rightx, righty, geometry=None, fits=None):
+    if fits is None:
+        # Fit a second order polynomial to each
+        left_fit, right_fit = lane_model.fit_batch([lefty, righty], [leftx, rightx])
+    else:
+        left_fit, right_fit = fits
     # LeftX Base = Bottom
     # RightX Base = Bottom
     ploty = np.linspace(0, 719, num=720)  # to cover same y-range as image
@@ -16,9 +19,7 @@ def draw_on_orig(binary_warped, undistorted, leftx, lefty, rightx, righty):
     left_fitx = left_fit[0] * ploty ** 2 + left_fit[1] * ploty + left_fit[2]
     right_fitx = right_fit[0] * ploty ** 2 + right_fit[1] * ploty + right_fit[2]
     # Calculate the position of the vehicle
-    rightx_int = right_fit[0] * 720 ** 2 + right_fit[1] * 720 + right_fit[2]
-    leftx_int = left_fit[0] * 720 ** 2 + left_fit[1] * 720 + left_fit[2]
-    center = abs(640 - ((rightx_int+leftx_int)/2))
+    center = center_offset(left_fit, right_fit)
     # Create an image to draw the lines on
     warp_zero = np.zeros_like(binary_warped).astype(np.uint8)
     color_warp = np.dstack((warp_zero, warp_zero, warp_zero))
@@ -30,8 +31,84 @@ def draw_on_orig(binary_warped, undistorted, leftx, lefty, rightx, righty):
     # Draw the lane onto the warped blank image
     cv2.fillPoly(color_warp, np.int_([pts]), (0, 255, 0))
     # Warp the blank back to original image space using inverse perspective matrix (Minv)
-    newwarp = persp_transform.get_warped_perspective(color_warp, reverse_persp=True)
+    if geometry is not None:
+        newwarp = geometry.warp(color_warp, reverse_persp=True)
+    else:
+        newwarp = persp_transform.get_warped_perspective(color_warp, reverse_persp=True)
     # Combine the result with the original image
     final = cv2.addWeighted(undistorted, 1, newwarp, 0.3, 0)
     # cv2.imwrite('final_ud.png', final)
     return final, center
+
+
+def center_offset(left_fit, right_fit):
+    """
+    Distance in pixels between the image center and the middle of the lane
+    at the bottom of the image
+    :param left_fit:
+    :param right_fit:
+    :return:
+    """
+    rightx_int = right_fit[0] * 720 ** 2 + right_fit[1] * 720 + right_fit[2]
+    leftx_int = left_fit[0] * 720 ** 2 + left_fit[1] * 720 + left_fit[2]
+    return abs(640 - ((rightx_int+leftx_int)/2))
+
+
+def draw_polygon(undistorted, polygon):
+    """
+    Overlay of a camera space lane polygon, e.g. one kept from a previous frame.
+    Same overlay as draw_on_orig without any full-frame pass: only the polygon
+    vertices go through the inverse homography (lane_polygon), the polygon is
+    filled in camera space and blended inside its bounding box only.
+    :param undistorted:
+    :param polygon: lane_polygon vertices
+    :return: final
+    """
+    final = undistorted.copy()
+    blend_polygon(final, polygon)
+    return final
+
+
+def lane_polygon(left_fit, right_fit, geometry, vertices=None):
+    """
+    Lane polygon in camera space
+    :param left_fit:
+    :param right_fit:
+    :param geometry:
+    :param vertices: points per lane edge
+    :return: (N, 2) int32 vertices
+    """
+    w, h = geometry.size
+    ploty = np.linspace(0, h - 1, num=vertices or h)
+    # Clip to the birds-eye frame, as warping the full polygon image back would
+    left_fitx = np.clip(np.polyval(left_fit, ploty), 0, w - 1)
+    right_fitx = np.clip(np.polyval(right_fit, ploty), 0, w - 1)
+    pts = np.vstack((np.column_stack((left_fitx, ploty)), np.column_stack((right_fitx, ploty))[::-1]))
+    pts = cv2.perspectiveTransform(pts.reshape(-1, 1, 2).astype(np.float32), geometry.inv_matrix)
+    return np.int32(np.round(pts.reshape(-1, 2)))
+
+
+def blend_polygon(img, polygon, color=(0, 255, 0), alpha=0.3):
+    """
+    In place img + alpha * color inside the polygon, like cv2.addWeighted
+    with a full-frame overlay but only touching the polygon's bounding box
+    :param img:
+    :param polygon: (N, 2) int32 vertices in img coordinates
+    :param color:
+    :param alpha:
+    :return: img
+    """
+    h, w = img.shape[:2]
+    x, y, bw, bh = cv2.boundingRect(polygon)
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + bw, w), min(y + bh, h)
+    if x1 <= x0 or y1 <= y0:
+        return img
+    mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+    cv2.fillPoly(mask, [polygon - (x0, y0)], 255)
+    roi = img[y0:y1, x0:x1]
+    for channel, value in enumerate(color):
+        if value:
+            layer = cv2.multiply(mask, value / 255.)
+            roi[:, :, channel] = cv2.addWeighted(roi[:, :, channel], 1, layer, alpha, 0)
+    return img
@@ -0,0 +1,153 @@
+import argparse
+import functools
+import json
+import os
+import sys
+import time
+
+
+# Startup optimized entry point for many short jobs on single images.
+# Only the standard library is imported at module level: cv2, numpy and the
+# pipeline modules are imported by load(), after the arguments are parsed, and
+# their cost is reported. Every image is independent: the Pipeline is reset()
+# before each one, which drops the lane tracking but keeps the tables.
+#
+# The remap tables are memory mapped from the geometry cache directory when an
+# earlier run saved them, so a cold process skips building them. With --workers
+# the process first builds the tables for the expected frame size with
+# Pipeline.prepare (no frame is processed), then forks a pool: the workers
+# inherit the imported modules and tables copy-on-write and take jobs right
+# away; --serve keeps that pool up and reads image paths from stdin, one per
+# line. Without workers nothing is built ahead, as the first image would pay for
+# it all the same.
+
+_START = time.perf_counter()
+
+# remap tables shared by every run, '' to build them in each process
+GEOMETRY_CACHE = 'camera_cal_final/geometry/'
+
+# Pipeline of this process, inherited with its tables by forked workers
+_pipeline = None
+
+
+def load(render=True, geometry_cache=None, config_path=None):
+    """
+    Import the pipeline and create this process's Pipeline
+    :param render: False to only compute the lane geometry
+    :param geometry_cache: remap table directory, overrides startup_configs['geometry_cache']
+    :param config_path: JSON config overrides, applied before anything is built
+    :return: seconds spent
+    """
+    global _pipeline
+    start = time.perf_counter()
+    import config
+    import live_config
+    import main
+    if config_path:
+        live_config.load(config_path)
+    if geometry_cache is not None:
+        config.startup_configs['geometry_cache'] = geometry_cache or None
+    _pipeline = main.Pipeline(render=render)
+    return time.perf_counter() - start
+
+
+def warm(size=None):
+    """
+    Build the loaded Pipeline's tables for frames of one size, e.g. before forking workers
+    :param size: (width, height), defaults to startup_configs['warm_size']
+    :return: seconds spent
+    """
+    import config
+    start = time.perf_counter()
+    w, h = size or config.startup_configs['warm_size']
+    _pipeline.prepare(w, h)
+    return time.perf_counter() - start
+
+
+def run_image(path, out_dir=None):
+    """
+    One independent image through this process's Pipeline
+    :param path:
+    :param out_dir: directory for the annotated image, None to not write it
+    :return: dict of the image path, its processing time and the Pipeline's last_result
+    """
+    import cv2
+    if _pipeline is None:
+        load()
+    start = time.perf_counter()
+    img = cv2.imread(path)
+    if img is None:
+        raise IOError('Could not read image {0}'.format(path))
+    _pipeline.reset()
+    out_img = _pipeline.main(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+    if out_dir and out_img is not None:
+        cv2.imwrite(os.path.join(out_dir, os.path.basename(path)), cv2.cvtColor(out_img, cv2.COLOR_RGB2BGR))
+    result = dict((k, v) for k, v in _pipeline.last_result.items() if not k.endswith('_windows'))
+    result.update({'path': path, 'ms': 1000. * (time.perf_counter() - start)})
+    return result
+
+
+def forked_pool(workers):
+    """
+    Worker processes forked from this process, call after warm() so they start with the tables built
+    :param workers: None for one per core
+    :return: multiprocessing Pool
+    """
+    import multiprocessing
+    return multiprocessing.get_context('fork').Pool(workers)
+
+
+def stdin_paths():
+    for line in sys.stdin:
+        line = line.strip()
+        if line:
+            yield line
+
+
+def _print_result(result):
+    print(json.dumps(result))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Annotate single images with minimal startup time')
+    parser.add_argument('images', nargs='*', help='image files, read from stdin with --serve')
+    parser.add_argument('--out-dir', help='write the annotated images here')
+    parser.add_argument('--no-render', action='store_true', help='only compute the lane geometry')
+    parser.add_argument('--size', metavar='WxH', help='frame size to build tables for before forking workers, '
+                                                      'defaults to startup_configs')
+    parser.add_argument('--workers', type=int, default=0, help='fork this many warmed workers, 0 for none')
+    parser.add_argument('--serve', action='store_true', help='process image paths read from stdin until EOF')
+    parser.add_argument('--geometry-cache', default=GEOMETRY_CACHE,
+                        help="directory of saved remap tables, '' to not use one")
+    parser.add_argument('--config', help='JSON config overrides')
+    args = parser.parse_args()
+    if not args.images and not args.serve:
+        parser.error('give image files or --serve')
+    if args.no_render and args.out_dir:
+        parser.error('--out-dir needs rendering')
+    size = tuple(int(v) for v in args.size.lower().split('x')) if args.size else None
+    if args.out_dir and not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+
+    loaded = load(render=not args.no_render, geometry_cache=args.geometry_cache, config_path=args.config)
+    warmed = warm(size) if args.workers else 0.
+    print('Imports {0:.0f} ms, warm up {1:.0f} ms'.format(1000 * loaded, 1000 * warmed), file=sys.stderr)
+    paths = stdin_paths() if args.serve else args.images
+    job = functools.partial(run_image, out_dir=args.out_dir)
+    pool = forked_pool(args.workers) if args.workers else None
+    first = None
+    count = 0
+    try:
+        for result in (pool.imap(job, paths) if pool is not None else map(job, paths)):
+            if first is None:
+                first = time.perf_counter() - _START
+                print('Time to first frame {0:.0f} ms ({1:.0f} ms processing)'.format(1000 * first, result['ms']),
+                      file=sys.stderr)
+            count += 1
+            _print_result(result)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print('{0} images in {1:.2f} s'.format(count, time.perf_counter() - _START), file=sys.stderr)
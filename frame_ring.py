@@ -0,0 +1,108 @@
+import collections
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+# Preallocated frame slots in one shared memory block, so worker processes read
+# input frames and write annotated frames in place. Only slot indices and the
+# small per-frame lane geometry cross the process boundary, never the pixels.
+#
+# Every slot has an input frame and an output frame: a slot can be read as a
+# warm-up frame by one worker while another writes its annotated output.
+
+
+class FrameRing(object):
+    def __init__(self, slots, shape, name=None):
+        """
+        :param slots: number of frame slots
+        :param shape: (h, w, 3) of every frame
+        :param name: attach to the existing block of that name, create a new one when None
+        """
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.owner = name is None
+        size = 2 * slots * int(np.prod(self.shape))
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = _attach(name)
+        self._block = np.ndarray((2, slots) + self.shape, dtype=np.uint8, buffer=self.shm.buf)
+        self.frames = self._block[0]
+        self.out = self._block[1]
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def spec(self):
+        """
+        :return: picklable (name, slots, shape), see attach
+        """
+        return self.name, self.slots, self.shape
+
+    @classmethod
+    def attach(cls, spec):
+        name, slots, shape = spec
+        return cls(slots, shape, name=name)
+
+    def close(self):
+        """
+        Drop the views and unmap the block, the creator also frees it
+        :return:
+        """
+        if self.shm is None:
+            return
+        self._block = self.frames = self.out = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+        self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SlotAllocator(object):
+    def __init__(self, slots):
+        """
+        Reference counted free list over the slots of a FrameRing,
+        a slot is free again once every holder released it
+        :param slots:
+        """
+        self.free = collections.deque(range(slots))
+        self.refs = [0] * slots
+
+    def acquire(self):
+        """
+        :return: a free slot index held once, None when every slot is taken
+        """
+        if not self.free:
+            return None
+        slot = self.free.popleft()
+        self.refs[slot] = 1
+        return slot
+
+    def retain(self, slots):
+        for slot in slots:
+            self.refs[slot] += 1
+
+    def release(self, slots):
+        for slot in slots:
+            self.refs[slot] -= 1
+            if self.refs[slot] == 0:
+                self.free.append(slot)
+
+
+def _attach(name):
+    """
+    Attach without registering with the resource tracker where Python allows
+    it, only the creating process owns (and unlinks) the block
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
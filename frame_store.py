@@ -0,0 +1,368 @@
+import argparse
+import itertools
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+
+import config
+import live_config
+import main
+import persp_transform
+import results
+import stream
+
+
+# Decode a video once, replay it many times. A frame store is a directory of
+# .npy arrays of frames, memory mapped for reading, so slicing out a frame or a
+# range of frames is a view of the page cache and costs no decode or copy:
+#   raw.npy          (N, h, w, 3) RGB frames as decoded
+#   undistorted.npy  optional, the frames undistorted (what the overlay is drawn on)
+#   warped.npy       optional, the birds-eye view at warp_scale
+#   index.json       frame range, size, which arrays exist and the geometry they were built with
+# Rows are video frame numbers first..first+count-1, so a store can keep only a
+# stretch of a video (e.g. the problem frames 975-1010) and still be addressed
+# by the original frame numbers.
+#
+# The undistorted and warped frames depend on the calibration and perspective
+# configs only, so they stay valid while threshold, hist and lane configs are
+# tuned. They are keyed by persp_transform.geometry_key and ignored (the
+# Pipeline works from the raw frames) as soon as the geometry differs.
+#
+# index.json is written last: a directory without one is an incomplete build.
+
+INDEX = 'index.json'
+VERSION = 1
+KINDS = ('raw', 'undistorted', 'warped')
+
+
+class _FrameWriter(object):
+    def __init__(self, path, shape):
+        """
+        Append-only .npy of uint8 frames, see results.ResultsWriter
+        :param path:
+        :param shape: (h, w, 3) of every frame
+        """
+        self.path = path
+        self.shape = tuple(shape)
+        self.rows = 0
+        self.file = open(path, 'wb')
+        self.file.write(results.npy_header(np.dtype(np.uint8), 0, self.shape))
+
+    def append(self, frame):
+        if frame.shape != self.shape:
+            raise ValueError('Frame of shape {0} in a store of {1} frames'.format(frame.shape, self.shape))
+        self.file.write(np.ascontiguousarray(frame, dtype=np.uint8).data)
+        self.rows += 1
+        if self.rows % config.store_configs['flush_frames'] == 0:
+            self.flush()
+
+    def flush(self):
+        end = self.file.tell()
+        self.file.seek(0)
+        self.file.write(results.npy_header(np.dtype(np.uint8), self.rows, self.shape))
+        self.file.seek(end)
+        self.file.flush()
+
+    def close(self):
+        if self.file is None:
+            return
+        self.flush()
+        self.file.close()
+        self.file = None
+
+
+def build_store(frames, directory, source=None, first=0, stop=None, undistorted=False, warped=False,
+                warp_scale=None, mtx=None, dist=None):
+    """
+    Decode once into a frame store
+    :param frames: iterable of RGB frames from the start of the video, e.g. stream.video_source(path)
+    :param directory: created when missing, an existing store there is replaced
+    :param source: name of the video, kept in the index
+    :param first: first frame number to keep, earlier frames are decoded and dropped
+    :param stop: frame number to stop before, None for the whole video
+    :param undistorted: also store the undistorted frames
+    :param warped: also store the birds-eye view
+    :param warp_scale: scale of the stored birds-eye view, defaults to resolution_configs['scale']
+    :param mtx: camera matrix, defaults to config.mtx
+    :param dist: distortion coefficients, defaults to config.dist
+    :return: FrameStore
+    """
+    mtx = config.mtx if mtx is None else mtx
+    dist = config.dist if dist is None else dist
+    warp_scale = warp_scale or config.resolution_configs['scale']
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    index_path = os.path.join(directory, INDEX)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    kinds = tuple(kind for kind, keep in zip(KINDS, (True, undistorted, warped)) if keep)
+    writers = {}
+    geometry = None
+    try:
+        for frame in itertools.islice(frames, first, stop):
+            if geometry is None:
+                h, w = frame.shape[:2]
+                geometry = persp_transform.get_geometry(w, h, mtx, dist)
+                warp_w, warp_h = geometry.scaled_size(warp_scale)
+                shapes = {'raw': frame.shape, 'undistorted': frame.shape, 'warped': (warp_h, warp_w, 3)}
+                for kind in kinds:
+                    writers[kind] = _FrameWriter(os.path.join(directory, kind + '.npy'), shapes[kind])
+            writers['raw'].append(frame)
+            if undistorted:
+                writers['undistorted'].append(geometry.undistort(frame))
+            if warped:
+                writers['warped'].append(geometry.undistort_and_warp(frame, scale=warp_scale))
+    finally:
+        for writer in writers.values():
+            writer.close()
+    if geometry is None:
+        raise ValueError('No frames in {0} from frame {1}'.format(source or 'the source', first))
+    w, h = geometry.size
+    index = {'version': VERSION,
+             'source': source,
+             'first': first,
+             'count': writers['raw'].rows,
+             'size': [w, h],
+             'arrays': dict((kind, kind + '.npy') for kind in kinds),
+             'warp_scale': warp_scale,
+             'geometry': persp_transform.geometry_key(w, h, mtx, dist)}
+    with open(index_path, 'w') as f:
+        json.dump(index, f, indent=2)
+    return FrameStore(directory)
+
+
+class FrameStore(object):
+    def __init__(self, directory):
+        """
+        Memory mapped frames of a store written by build_store
+        :param directory:
+        """
+        path = os.path.join(directory, INDEX)
+        if not os.path.exists(path):
+            raise IOError('No frame store in {0}, or its build did not finish'.format(directory))
+        with open(path) as f:
+            self.index = json.load(f)
+        if self.index['version'] != VERSION:
+            raise ValueError('Frame store {0} is version {1}, rebuild it'.format(directory, self.index['version']))
+        self.directory = directory
+        self.first = self.index['first']
+        self.count = self.index['count']
+        self.size = tuple(self.index['size'])
+        self.warp_scale = self.index['warp_scale']
+        self.arrays = dict((kind, np.load(os.path.join(directory, name), mmap_mode='r'))
+                           for kind, name in self.index['arrays'].items())
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def stop(self):
+        """Frame number after the last stored frame"""
+        return self.first + self.count
+
+    def frames(self, start=None, stop=None, kind='raw'):
+        """
+        Zero-copy view of a range of frames
+        :param start: first frame number, defaults to the first stored frame
+        :param stop: frame number to stop before, defaults to the end of the store
+        :param kind: 'raw', 'undistorted' or 'warped'
+        :return: (n, h, w, 3) read-only array
+        """
+        if kind not in self.arrays:
+            raise ValueError('Frame store {0} has no {1} frames'.format(self.directory, kind))
+        start = self.first if start is None else start
+        stop = self.stop if stop is None else stop
+        if not self.first <= start <= stop <= self.stop:
+            raise IndexError('Frames {0}-{1} are not all in the store, it has {2}-{3}'.format(
+                start, stop, self.first, self.stop))
+        return self.arrays[kind][start - self.first:stop - self.first]
+
+    def frame(self, num, kind='raw'):
+        """
+        :param num: frame number
+        :param kind:
+        :return: (h, w, 3) read-only view
+        """
+        return self.frames(num, num + 1, kind)[0]
+
+    def geometry_valid(self, mtx=None, dist=None):
+        """
+        Whether the stored undistorted and warped frames match the current
+        calibration and perspective configs
+        :param mtx:
+        :param dist:
+        :return:
+        """
+        return self.index['geometry'] == persp_transform.geometry_key(self.size[0], self.size[1], mtx, dist)
+
+    def replay(self, pipeline, start=None, stop=None, warmup=None, mode=main.FULL):
+        """
+        Run a range of frames through a Pipeline. The frames before start (up to
+        warmup of them) are run first without drawing, so the lane tracking is in
+        the state a run over the whole video would have reached.
+        :param pipeline: main.Pipeline, its frame_num is set to frame number + 1 as in a run over the whole video
+        :param start:
+        :param stop:
+        :param warmup: defaults to store_configs['warmup_frames']
+        :param mode:
+        :return: generator of (frame number, Pipeline.main output)
+        """
+        start = self.first if start is None else start
+        stop = self.stop if stop is None else stop
+        self.frames(start, stop)
+        warmup = config.store_configs['warmup_frames'] if warmup is None else warmup
+        begin = max(self.first, start - warmup)
+        raw = self.frames(begin, stop)
+        undistorted = self.arrays.get('undistorted')
+        warped = self.arrays.get('warped')
+        pipeline.frame_num = begin + 1
+        render = pipeline.render
+        pipeline.render = False
+        try:
+            for i, num in enumerate(range(begin, stop)):
+                if num == start:
+                    pipeline.render = render
+                row = num - self.first
+                # Checked every frame, the perspective configs may be reloaded mid-run
+                prepared = self.geometry_valid(pipeline.mtx, pipeline.dist)
+                out = pipeline.main(raw[i], mode=mode,
+                                    undistorted=undistorted[row] if prepared and undistorted is not None else None,
+                                    warped=warped[row] if prepared and warped is not None else None)
+                if num >= start:
+                    yield num, out
+        finally:
+            pipeline.render = render
+
+
+def sweep(store, grid, start=None, stop=None, warmup=None, out_dir=None):
+    """
+    Every combination of config values over the same frames, each with a fresh
+    non-rendering Pipeline. The configs are restored afterwards.
+    :param store: FrameStore
+    :param grid: {section: {key: [values]}}, e.g. {"threshold_configs": {"sobel_min": [15, 20, 25]}}
+    :param start:
+    :param stop:
+    :param warmup:
+    :param out_dir: optional directory for each run's per-frame results (run_NNN.npy) and sweep.json
+    :return: list of per-run summaries
+    """
+    axes = [(section, key, values) for section, keys in sorted(grid.items()) for key, values in sorted(keys.items())]
+    for section, key, _ in axes:
+        if section not in live_config.sections() or key not in getattr(config, section):
+            raise ValueError('Unknown config {0}[{1!r}]'.format(section, key))
+    base = {}
+    for section, key, _ in axes:
+        base.setdefault(section, {})[key] = getattr(config, section)[key]
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    runs = []
+    try:
+        for n, combo in enumerate(itertools.product(*[values for _, _, values in axes])):
+            overrides = {}
+            for (section, key, _), value in zip(axes, combo):
+                overrides.setdefault(section, {})[key] = value
+            for section, values in overrides.items():
+                live_config.update(section, **values)
+            pipeline = main.Pipeline(render=False)
+            writer = results.ResultsWriter(os.path.join(out_dir, 'run_{0:03d}.npy'.format(n))) if out_dir else None
+            frames = trusted = 0
+            begin = time.perf_counter()
+            try:
+                for _ in store.replay(pipeline, start, stop, warmup):
+                    frames += 1
+                    trusted += pipeline.last_result['trusted']
+                    if writer is not None:
+                        writer.append(pipeline.last_result)
+            finally:
+                if writer is not None:
+                    writer.close()
+            seconds = time.perf_counter() - begin
+            runs.append({'run': n,
+                         'configs': overrides,
+                         'frames': frames,
+                         'trusted_rate': trusted / float(frames) if frames else 0.,
+                         'seconds': seconds,
+                         'fps': frames / seconds if seconds else 0.})
+    finally:
+        for section, values in base.items():
+            live_config.update(section, **values)
+    if out_dir:
+        with open(os.path.join(out_dir, 'sweep.json'), 'w') as f:
+            json.dump(runs, f, indent=2)
+    return runs
+
+
+def _frame_range(value):
+    """
+    :param value: 'START:STOP', either side may be empty
+    :return: (start, stop), None for an open side
+    """
+    start, _, stop = value.partition(':')
+    return int(start) if start else None, int(stop) if stop else None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Decode a video once, replay and tune on its frames')
+    parser.add_argument('command', choices=['build', 'info', 'replay', 'sweep'])
+    parser.add_argument('store', help='frame store directory')
+    parser.add_argument('--video', help='build: video file to decode')
+    parser.add_argument('--images', help='build: directory of images instead of a video')
+    parser.add_argument('--undistorted', action='store_true', help='build: also store undistorted frames')
+    parser.add_argument('--warped', action='store_true', help='build: also store the birds-eye view')
+    parser.add_argument('--warp-scale', type=float, default=None, help='build: scale of the stored birds-eye view')
+    parser.add_argument('--frames', type=_frame_range, default=(None, None), metavar='START:STOP',
+                        help='frame numbers to store, replay or sweep, e.g. 975:1010')
+    parser.add_argument('--warmup', type=int, default=None, help='frames before START replayed first')
+    parser.add_argument('--out-dir', help='replay: annotated frames; sweep: per-run results and sweep.json')
+    parser.add_argument('--results', help='replay: write per-frame lane geometry to this .npy file')
+    parser.add_argument('--no-render', action='store_true', help='replay: only compute the lane geometry')
+    parser.add_argument('--grid', help='sweep: JSON file of {section: {key: [values]}}')
+    parser.add_argument('--config', help='JSON config overrides')
+    args = parser.parse_args()
+    if args.config:
+        live_config.load(args.config)
+    start, stop = args.frames
+
+    if args.command == 'build':
+        if not (args.video or args.images):
+            parser.error('build needs --video or --images')
+        frames = stream.video_source(args.video) if args.video else stream.image_dir_source(args.images)
+        begin = time.perf_counter()
+        store = build_store(frames, args.store, source=args.video or args.images, first=start or 0, stop=stop,
+                            undistorted=args.undistorted, warped=args.warped, warp_scale=args.warp_scale)
+        print('Stored frames {0}-{1} in {2:.1f} s'.format(store.first, store.stop, time.perf_counter() - begin))
+    elif args.command == 'info':
+        store = FrameStore(args.store)
+        print(json.dumps(dict(store.index, geometry_valid=store.geometry_valid()), indent=2))
+    elif args.command == 'replay':
+        store = FrameStore(args.store)
+        pipeline = main.Pipeline(render=not args.no_render)
+        writer = results.ResultsWriter(args.results) if args.results else None
+        if args.out_dir and not os.path.exists(args.out_dir):
+            os.makedirs(args.out_dir)
+        begin = time.perf_counter()
+        count = 0
+        try:
+            for num, out in store.replay(pipeline, start, stop, args.warmup):
+                count += 1
+                if writer is not None:
+                    writer.append(pipeline.last_result)
+                if args.out_dir and out is not None:
+                    cv2.imwrite(os.path.join(args.out_dir, 'frame_{0:06d}.png'.format(num)),
+                                cv2.cvtColor(out, cv2.COLOR_RGB2BGR))
+        finally:
+            if writer is not None:
+                writer.close()
+        seconds = time.perf_counter() - begin
+        print('{0} frames in {1:.2f} s ({2:.1f} fps)'.format(count, seconds, count / seconds if seconds else 0.))
+    else:
+        if not args.grid:
+            parser.error('sweep needs --grid')
+        with open(args.grid) as f:
+            grid = json.load(f)
+        for run in sweep(FrameStore(args.store), grid, start, stop, args.warmup, args.out_dir):
+            print('{0:3d} {1:6.1f} fps  trusted {2:5.1%}  {3}'.format(run['run'], run['fps'], run['trusted_rate'],
+                                                                      json.dumps(run['configs'])))
@@ -1,43 +1,65 @@
+import sys
+
 import cv2
 import numpy as np
 
 import config
+import lane_model
+import live_config
+import profiling
+
+# Conversions in x and y from pixels space to meters
+ym_per_pix = lane_model.ym_per_pix
+xm_per_pix = lane_model.xm_per_pix
 
 
-def get_window_for_lane(binary_warped, last_good_lane=None):
-    # Assuming you have created a warped binary image called "binary_warped"
-    # Take a histogram of the bottom half of the image
-    histogram = np.sum(binary_warped[binary_warped.shape[0] / 2:, :], axis=0)
+def get_window_for_lane(binary_warped, last_good_lane=None, timer=profiling.disabled, bases=None,
+                        curvature=True, scale=1.0):
+    """
+    Histogram + sliding window lane search
+    :param binary_warped:
+    :param last_good_lane: bases to fall back to when the histogram peaks give a bad lane width
+    :param timer:
+    :param bases: (leftx_base, rightx_base) already found in binary_warped, e.g. by find_bases_batch
+    :param curvature: False skips get_center_radius, the curvatures are then None
+    :param scale: size of binary_warped relative to the full resolution birds-eye view.
+                  Window sizes and lane widths are scaled to match, and every
+                  position returned (and last_good_lane) is in full resolution pixels
+    :return:
+    """
     # Create an output image to draw on and  visualize the result
     out_img = np.dstack((binary_warped, binary_warped, binary_warped)) * 255
-    # Find the peak of the left and right halves of the histogram
-    # These will be the starting point for the left and right lines
-    midpoint = np.int(histogram.shape[0] / 2)
-    leftx_base = np.argmax(histogram[:midpoint])
-    rightx_base = np.argmax(histogram[midpoint:]) + midpoint
+    if bases is None:
+        # Assuming you have created a warped binary image called "binary_warped"
+        # Take a histogram of the bottom half of the image
+        histogram = np.sum(binary_warped[binary_warped.shape[0] // 2:, :], axis=0)
+        # Find the peak of the left and right halves of the histogram
+        # These will be the starting point for the left and right lines
+        midpoint = int(histogram.shape[0] / 2)
+        leftx_base = np.argmax(histogram[:midpoint])
+        rightx_base = np.argmax(histogram[midpoint:]) + midpoint
+    else:
+        leftx_base, rightx_base = bases
     if last_good_lane and (
-                    abs(leftx_base - rightx_base) > config.lane_configs['max_width'] or abs(leftx_base - rightx_base) <
-                config.lane_configs['min_width']):
+                    abs(leftx_base - rightx_base) > config.lane_configs['max_width'] * scale or
+                    abs(leftx_base - rightx_base) < config.lane_configs['min_width'] * scale):
         print(
             'Overruling base. Old Left, Right = {0}, {1}, New L, R = {2}'.format(leftx_base, rightx_base,
-                                                                                 last_good_lane))
-        leftx_base, rightx_base = last_good_lane[0], last_good_lane[1]
-
-    # Choose the number of sliding windows
-    nwindows = 9
-    # Set height of windows
-    window_size = np.int(binary_warped.shape[0] / nwindows)
-    # Identify the x and y positions of all nonzero pixels in the image
-    nonzero = binary_warped.nonzero()
-    nonzeroy = np.array(nonzero[0])
-    nonzerox = np.array(nonzero[1])
+                                                                                 last_good_lane), file=sys.stderr)
+        leftx_base, rightx_base = int(last_good_lane[0] * scale), int(last_good_lane[1] * scale)
+
+    # Sliding windows: row bounds, +/- margin and minimum pixels to recenter
+    window_bounds, margin, minpix = window_layout(binary_warped.shape[0], scale)
+    nwindows = len(window_bounds) - 1
+    # Identify the x and y positions of all nonzero pixels in the image.
+    # nonzero() walks the image row by row, so nonzeroy is already sorted
+    nonzeroy, nonzerox = binary_warped.nonzero()
+    # Row index: offsets of each window's rows into the sorted pixels,
+    # so every window only touches its own band of pixels
+    window_offsets = np.searchsorted(nonzeroy, window_bounds)
     # Current positions to be updated for each window
     leftx_current_lst = [leftx_base]
     rightx_current_lst = [rightx_base]
-    # Set the width of the windows +/- margin
-    margin = 100
-    # Set minimum number of pixels found to recenter window
-    minpix = 50
     # Create empty lists to receive left and right lane pixel indices
     left_lane_inds = []
     right_lane_inds = []
@@ -47,35 +69,30 @@ def get_window_for_lane(binary_warped, last_good_lane=None):
         leftx_current = leftx_current_lst[-1]
         rightx_current = rightx_current_lst[-1]
         # Identify window boundaries in x and y (and right and left)
-        win_y_low = binary_warped.shape[0] - (window + 1) * window_size
-        win_y_high = binary_warped.shape[0] - window * window_size
+        win_y_low = window_bounds[window + 1]
+        win_y_high = window_bounds[window]
         win_xleft_low = leftx_current - margin
         win_xleft_high = leftx_current + margin
         win_xright_low = rightx_current - margin
         win_xright_high = rightx_current + margin
         # Draw the windows on the visualization image
-        # print([(win_xleft_low, win_y_low), (win_xleft_high, win_y_high), (0, 255, 0)])
-        # cv2.imwrite('win_full_{0}.png'.format(window), binary_warped[win_y_low:win_y_high, :])
-        # cv2.imwrite('win_{0}.png'.format(window), binary_warped[win_y_low:win_y_high, win_xleft_low:win_xleft_high])
-        cv2.rectangle(out_img, (win_xleft_low, win_y_low), (win_xleft_high, win_y_high), (0, 255, 0), 2)
-        cv2.rectangle(out_img, (win_xright_low, win_y_low), (win_xright_high, win_y_high), (0, 255, 0), 2)
-        # Identify the nonzero pixels in x and y within the window
-        good_left_inds = ((nonzeroy >= win_y_low) & (nonzeroy < win_y_high) & (nonzerox >= win_xleft_low) & (
-            nonzerox < win_xleft_high)).nonzero()[0]
-        good_right_inds = ((nonzeroy >= win_y_low) & (nonzeroy < win_y_high) & (nonzerox >= win_xright_low) & (
-            nonzerox < win_xright_high)).nonzero()[0]
+        cv2.rectangle(out_img, (int(win_xleft_low), int(win_y_low)), (int(win_xleft_high), int(win_y_high)),
+                      (0, 255, 0), 2)
+        cv2.rectangle(out_img, (int(win_xright_low), int(win_y_low)), (int(win_xright_high), int(win_y_high)),
+                      (0, 255, 0), 2)
+        # Identify the nonzero pixels in x within the window's band of rows
+        band_start = window_offsets[window + 1]
+        band_x = nonzerox[band_start:window_offsets[window]]
+        good_left_inds = ((band_x >= win_xleft_low) & (band_x < win_xleft_high)).nonzero()[0] + band_start
+        good_right_inds = ((band_x >= win_xright_low) & (band_x < win_xright_high)).nonzero()[0] + band_start
         # Append these indices to the lists
         left_lane_inds.append(good_left_inds)
         right_lane_inds.append(good_right_inds)
         # If you found > minpix pixels, recenter next window on their mean position
-        if len(good_left_inds) > minpix: # and window < 8:
-            # print(window)
-            # print(good_left_inds)
-            # print('leftx_current_b4 = {0}'.format(leftx_current))
-            leftx_current_lst.append(np.int(np.mean(nonzerox[good_left_inds])))
-            # print('leftx_current_after = {0}'.format(leftx_current))
-        if len(good_right_inds) > minpix: # and window < 8:
-            rightx_current_lst.append(np.int(np.mean(nonzerox[good_right_inds])))
+        if len(good_left_inds) > minpix:
+            leftx_current_lst.append(int(np.mean(nonzerox[good_left_inds])))
+        if len(good_right_inds) > minpix:
+            rightx_current_lst.append(int(np.mean(nonzerox[good_right_inds])))
 
     # Concatenate the arrays of indices
     left_lane_inds = np.concatenate(left_lane_inds)
@@ -86,20 +103,187 @@ def get_window_for_lane(binary_warped, last_good_lane=None):
     lefty = nonzeroy[left_lane_inds]
     rightx = nonzerox[right_lane_inds]
     righty = nonzeroy[right_lane_inds]
-    left_curverad, right_curverad = get_center_radius(lefty, leftx, righty, rightx)
+    if scale != 1.0:
+        # Back to full resolution pixels
+        leftx, lefty, rightx, righty = leftx / scale, lefty / scale, rightx / scale, righty / scale
+        leftx_base, rightx_base = int(leftx_base / scale), int(rightx_base / scale)
+        leftx_current_lst = [int(x / scale) for x in leftx_current_lst]
+        rightx_current_lst = [int(x / scale) for x in rightx_current_lst]
+    left_curverad, right_curverad = None, None
+    if curvature:
+        with timer.stage('curvature'):
+            left_curverad, right_curverad = get_center_radius(lefty, leftx, righty, rightx)
 
     return out_img, leftx, lefty, rightx, righty, leftx_base, rightx_base, left_curverad, right_curverad, leftx_current_lst, rightx_current_lst
 
 
+@live_config.derived('hist_configs')
+def window_layout(height, scale):
+    """
+    Sliding window layout of a birds-eye view
+    :param height: rows of the (scaled) birds-eye view
+    :param scale: size of the view relative to full resolution
+    :return: window_bounds (nwindows + 1 row bounds, bottom up), margin, minpix
+    """
+    nwindows = config.hist_configs['nwindows']
+    window_size = int(height / nwindows)
+    window_bounds = height - np.arange(nwindows + 1) * window_size
+    margin = int(config.hist_configs['window_margin'] * scale)
+    minpix = config.hist_configs['minpix'] * scale * scale
+    return window_bounds, margin, minpix
+
+
+def search_around_poly(binary_warped, left_fit, right_fit, margin=None, timer=profiling.disabled, scale=1.0,
+                       curvature=True):
+    """
+    Look-ahead search: only keep the pixels within +/- margin of the
+    previous frame's polynomial fits instead of re-running the histogram
+    and sliding windows.
+    Returns the same tuple as get_window_for_lane
+    :param binary_warped:
+    :param left_fit: pixel-space fit from the previous frame
+    :param right_fit: pixel-space fit from the previous frame
+    :param margin: full resolution pixels
+    :param timer:
+    :param scale: size of binary_warped relative to the full resolution birds-eye view,
+                  fits and everything returned are in full resolution pixels
+    :param curvature: False skips get_center_radius, the curvatures are then None
+    :return:
+    """
+    found, _ = lookahead_search(binary_warped, left_fit, right_fit, margin=margin, scale=scale)
+    out_img, leftx, lefty, rightx, righty, leftx_base, rightx_base = found[:7]
+    if not curvature:
+        left_curverad, right_curverad = None, None
+    elif len(leftx) > 2 and len(rightx) > 2:
+        with timer.stage('curvature'):
+            left_curverad, right_curverad = get_center_radius(lefty, leftx, righty, rightx)
+    else:
+        left_curverad, right_curverad = np.inf, np.inf
+    return found[:7] + (left_curverad, right_curverad) + found[9:]
+
+
+def lookahead_search(binary_warped, left_fit, right_fit, margin=None, scale=1.0):
+    """
+    search_around_poly without the curvatures, also returning the fits of the pixels found.
+    The bases are where this frame's fits hit the bottom of the image, so
+    is_confident checks this frame's detection rather than the prior.
+    :param binary_warped:
+    :param left_fit: pixel-space fit from the previous frame
+    :param right_fit:
+    :param margin: full resolution pixels
+    :param scale:
+    :return: found, fits: the get_window_for_lane tuple with None curvatures, and the
+             (left_fit, right_fit) of the found pixels, None when a lane has too few
+             pixels to fit (the bases are then the prior's)
+    """
+    if margin is None:
+        margin = config.hist_configs['lookahead_margin']
+    out_img = np.dstack((binary_warped, binary_warped, binary_warped)) * 255
+    nonzero = binary_warped.nonzero()
+    nonzeroy = np.array(nonzero[0])
+    nonzerox = np.array(nonzero[1])
+    if scale != 1.0:
+        nonzeroy, nonzerox = nonzeroy / scale, nonzerox / scale
+    left_center = np.polyval(left_fit, nonzeroy)
+    right_center = np.polyval(right_fit, nonzeroy)
+    left_lane_inds = ((nonzerox > left_center - margin) & (nonzerox < left_center + margin)).nonzero()[0]
+    right_lane_inds = ((nonzerox > right_center - margin) & (nonzerox < right_center + margin)).nonzero()[0]
+
+    leftx = nonzerox[left_lane_inds]
+    lefty = nonzeroy[left_lane_inds]
+    rightx = nonzerox[right_lane_inds]
+    righty = nonzeroy[right_lane_inds]
+    bottom = binary_warped.shape[0] / scale - 1
+    fits = None
+    if len(lefty) >= 3 and len(righty) >= 3:
+        fits = lane_model.fit_batch([lefty, righty], [leftx, rightx])
+        fits = fits[0], fits[1]
+    base_fits = fits or (left_fit, right_fit)
+    leftx_base = int(np.polyval(base_fits[0], bottom))
+    rightx_base = int(np.polyval(base_fits[1], bottom))
+    return (out_img, leftx, lefty, rightx, righty, leftx_base, rightx_base, None, None,
+            [leftx_base], [rightx_base]), fits
+
+
+def is_confident(leftx, rightx, leftx_base, rightx_base, scale=1.0):
+    """
+    Confidence check on a lane search: enough pixels on both lanes and
+    a lane width within config.lane_configs
+    :param leftx:
+    :param rightx:
+    :param leftx_base: full resolution pixels
+    :param rightx_base:
+    :param scale: detection scale the pixels were found at, pixel counts shrink with its square
+    :return:
+    """
+    min_pixels = config.hist_configs['min_lane_pixels'] * scale * scale
+    if len(leftx) < min_pixels or len(rightx) < min_pixels:
+        return False
+    width = abs(leftx_base - rightx_base)
+    return config.lane_configs['min_width'] <= width <= config.lane_configs['max_width']
+
+
+def points_from_fit(fit, height):
+    """
+    Pixels along a fit, used to stand in for a lane when the current frame
+    could not be trusted
+    :param fit:
+    :param height:
+    :return: x, y
+    """
+    y = np.arange(height)
+    return np.polyval(fit, y), y
+
+
+def find_bases_batch(binary_warped):
+    """
+    Histogram peaks of the bottom half for a whole batch at once,
+    the same bases get_window_for_lane finds frame by frame
+    :param binary_warped: (N, H, W) masks
+    :return: (N, 2) array of leftx_base, rightx_base
+    """
+    h, w = binary_warped.shape[1:]
+    histograms = binary_warped[:, h // 2:, :].sum(axis=1, dtype=np.int64)
+    midpoint = int(w / 2)
+    leftx_base = histograms[:, :midpoint].argmax(axis=1)
+    rightx_base = histograms[:, midpoint:].argmax(axis=1) + midpoint
+    return np.stack((leftx_base, rightx_base), axis=1)
+
+
+def fit_polynomials_batch(ys, xs, height):
+    """
+    Second order fits x = f(y) for many pixel sets with one batched
+    solve instead of one fit each, see lane_model.fit_batch
+    :param ys: list of y pixel arrays
+    :param xs: list of x pixel arrays
+    :param height: image height
+    :return: (N, 3) coefficients, highest power first like np.polyfit
+    """
+    return lane_model.fit_batch(ys, xs, height)
+
+
+def get_center_radius_from_fits(fits, y_eval):
+    """
+    get_center_radius from pixel space fits: the meter space fit is the
+    pixel fit rescaled, so no refit is needed. Works on any leading shape.
+    :param fits: (..., 3) pixel space coefficients
+    :param y_eval: pixel row to evaluate the curvature at, e.g. each lane's lowest pixel
+    :return: radii in meters
+    """
+    return lane_model.curvature(fits, y_eval)
+
+
 def get_center_radius(lefty, leftx, righty, rightx):
-    # Define conversions in x and y from pixels space to meters
-    ym_per_pix = 30./720 # meters per pixel in y dimension
-    xm_per_pix = 3.7/700 # meteres per pixel in x dimension
-    left_fit_cr = np.polyfit(lefty*ym_per_pix, leftx*xm_per_pix, 2)
-    right_fit_cr = np.polyfit(righty*ym_per_pix, rightx*xm_per_pix, 2)
-    left_curverad = ((1 + (2*left_fit_cr[0]*np.max(lefty) + left_fit_cr[1])**2)**1.5) / np.absolute(2*left_fit_cr[0])
-    right_curverad = ((1 + (2 * right_fit_cr[0] * np.max(lefty) + right_fit_cr[1]) ** 2) ** 1.5) \
-                     / np.absolute(2 * right_fit_cr[0])
+    """
+    Radius of curvature in meters of each lane, at that lane's lowest pixel
+    :param lefty:
+    :param leftx:
+    :param righty:
+    :param rightx:
+    :return: left_curverad, right_curverad
+    """
+    fits = lane_model.fit_batch([lefty, righty], [leftx, rightx])
     # Now our radius of curvature is in meters
     # Example values: 632.1 m    626.2 m
-    return left_curverad, right_curverad
\ No newline at end of file
+    left_curverad, right_curverad = lane_model.curvature(fits, [np.max(lefty), np.max(righty)])
+    return left_curverad, right_curverad
@@ -0,0 +1,175 @@
+import numpy as np
+
+import config
+
+# Conversions in x and y from pixels space to meters
+ym_per_pix = 30. / 720  # meters per pixel in y dimension
+xm_per_pix = 3.7 / 700  # meters per pixel in x dimension
+
+
+# Second order lane model x = a*y^2 + b*y + c, fitted once per lane in pixel
+# space. The least-squares solution comes from moment sums (sum w*y^k for
+# k <= 4 and sum w*x*y^k for k <= 2), accumulated for every pixel set of a
+# frame or a whole batch with np.bincount and solved as stacked 3x3 normal
+# equations. Meter space coefficients follow analytically from the pixel ones,
+# so curvature never needs a second fit.
+#
+# Methods (fit_configs['method']):
+#   'lsq'    plain (optionally weighted) least squares
+#   'irls'   iteratively reweighted least squares with Tukey's biweight,
+#            robust to stray pixels such as shadows or other road markings
+#   'ransac' best 3 point model by inlier count, refitted on its inliers
+
+
+def fit(y, x, weights=None, method=None):
+    """
+    Pixel space fit x = f(y) of one lane
+    :param y:
+    :param x:
+    :param weights: optional per pixel weights
+    :param method: 'lsq', 'irls' or 'ransac', defaults to fit_configs['method']
+    :return: (3,) coefficients, highest power first like np.polyfit
+    """
+    return fit_batch([y], [x], weights=None if weights is None else [weights], method=method)[0]
+
+
+def fit_batch(ys, xs, height=None, weights=None, method=None):
+    """
+    Fits of many pixel sets at once, one stacked solve per iteration
+    :param ys: list of y pixel arrays
+    :param xs: list of x pixel arrays
+    :param height: scale of y used to keep the moment sums well conditioned, defaults to the largest y
+    :param weights: optional list of per pixel weight arrays
+    :param method:
+    :return: (N, 3) coefficients
+    """
+    method = method or config.fit_configs['method']
+    if method == 'ransac':
+        return np.array([fit_ransac(y, x) for y, x in zip(ys, xs)]).reshape(len(ys), 3)
+    if method not in ('lsq', 'irls'):
+        raise ValueError('Unknown fit method {0}'.format(method))
+    n = len(ys)
+    lengths = [len(y) for y in ys]
+    ids = np.repeat(np.arange(n), lengths)
+    y = np.concatenate(ys).astype(np.float64)
+    x = np.concatenate(xs).astype(np.float64)
+    w = np.ones_like(y) if weights is None else np.concatenate(weights).astype(np.float64)
+    y_scale = float(height or (np.abs(y).max() if len(y) else 1.)) or 1.
+    coeffs = _solve(ids, n, y / y_scale, x, w)
+    if method == 'irls':
+        coeffs = _irls(ids, n, lengths, y / y_scale, x, w, coeffs)
+    return _unscale(coeffs, y_scale)
+
+
+def _solve(ids, n, y, x, w):
+    """
+    Weighted least squares of every set from its moment sums, y already scaled
+    :return: (N, 3) coefficients in scaled y
+    """
+    y2 = y * y
+    y_pows = (w, w * y, w * y2, w * y2 * y, w * y2 * y2)
+    y_sums = [np.bincount(ids, weights=p, minlength=n) for p in y_pows]
+    xy_sums = [np.bincount(ids, weights=x * y_pows[k], minlength=n) for k in range(3)]
+    normal = np.empty((n, 3, 3))
+    for i in range(3):
+        for j in range(3):
+            normal[:, i, j] = y_sums[4 - i - j]
+    rhs = np.stack((xy_sums[2], xy_sums[1], xy_sums[0]), axis=1)[:, :, None]
+    try:
+        return np.linalg.solve(normal, rhs)[:, :, 0]
+    except np.linalg.LinAlgError:
+        # A set with fewer than 3 distinct rows, fall back to the least-norm solution
+        return np.matmul(np.linalg.pinv(normal), rhs)[:, :, 0]
+
+
+def _irls(ids, n, lengths, y, x, w, coeffs):
+    """
+    Tukey biweight reweighting, the residual scale of each set is its median
+    absolute residual (floored at min_scale_px pixels)
+    """
+    tuning = config.fit_configs['irls_tuning']
+    offsets = np.cumsum(lengths)[:-1]
+    for _ in range(config.fit_configs['irls_iterations']):
+        c = coeffs[ids]
+        resid = np.abs(x - (c[:, 0] * y + c[:, 1]) * y - c[:, 2])
+        scale = np.array([1.4826 * np.median(r) if len(r) else 1. for r in np.split(resid, offsets)])
+        u = resid / (tuning * np.maximum(scale, config.fit_configs['min_scale_px']))[ids]
+        robust = np.where(u < 1, (1 - u * u) ** 2, 0.) * w
+        # Sets left with too few pixels keep their previous weights
+        kept = np.bincount(ids, weights=robust > 0, minlength=n)
+        robust = np.where((kept >= 3)[ids], robust, w)
+        coeffs = _solve(ids, n, y, x, robust)
+    return coeffs
+
+
+def _unscale(coeffs, y_scale):
+    coeffs[:, 0] /= y_scale ** 2
+    coeffs[:, 1] /= y_scale
+    return coeffs
+
+
+def fit_ransac(y, x, iterations=None, threshold=None, seed=None):
+    """
+    RANSAC: the 3 pixel model with the most pixels within threshold, refitted
+    by least squares on those inliers. Deterministic for a given seed.
+    :param y:
+    :param x:
+    :param iterations: candidate models, defaults to fit_configs['ransac_iterations']
+    :param threshold: inlier distance in x pixels, defaults to fit_configs['ransac_threshold_px']
+    :param seed:
+    :return: (3,) coefficients
+    """
+    y = np.asarray(y, dtype=np.float64)
+    x = np.asarray(x, dtype=np.float64)
+    if len(y) <= 3:
+        return fit(y, x, method='lsq')
+    iterations = iterations or config.fit_configs['ransac_iterations']
+    threshold = threshold or config.fit_configs['ransac_threshold_px']
+    seed = config.fit_configs['ransac_seed'] if seed is None else seed
+    y_scale = np.abs(y).max() or 1.
+    ys = y / y_scale
+    picks = np.random.RandomState(seed).randint(0, len(y), size=(iterations, 3))
+    vander = np.stack((ys[picks] ** 2, ys[picks], np.ones(picks.shape)), axis=2)
+    # Skip samples with repeated rows, their 3x3 system is singular
+    ok = np.abs(np.linalg.det(vander)) > 1e-12
+    if not ok.any():
+        return fit(y, x, method='lsq')
+    candidates = np.linalg.solve(vander[ok], x[picks[ok]][:, :, None])[:, :, 0]
+    resid = np.abs(x - (candidates[:, :1] * ys + candidates[:, 1:2]) * ys - candidates[:, 2:])
+    inliers = resid < threshold
+    best = inliers[np.argmax(inliers.sum(axis=1))]
+    return fit(y[best], x[best], method='lsq')
+
+
+def to_meters(fits):
+    """
+    Meter space coefficients of pixel space fits: x_m = xm * f(y_m / ym)
+    :param fits: (..., 3) pixel space coefficients
+    :return: (..., 3) meter space coefficients
+    """
+    fits = np.asarray(fits, dtype=np.float64)
+    return fits * np.array([xm_per_pix / ym_per_pix ** 2, xm_per_pix / ym_per_pix, xm_per_pix])
+
+
+def curvature(fits, y_eval):
+    """
+    Radius of curvature in meters
+    :param fits: (..., 3) pixel space coefficients
+    :param y_eval: pixel row to evaluate at (broadcast against fits), e.g. the lane's lowest pixel
+    :return: radii in meters, inf for a straight lane
+    """
+    meters = to_meters(fits)
+    a, b = meters[..., 0], meters[..., 1]
+    y_m = np.asarray(y_eval, dtype=np.float64) * ym_per_pix
+    with np.errstate(divide='ignore'):
+        return ((1 + (2 * a * y_m + b) ** 2) ** 1.5) / np.absolute(2 * a)
+
+
+def lane_bottom(y, height):
+    """
+    Row a lane's curvature is evaluated at: its lowest pixel, the image bottom when it has none
+    :param y: the lane's y pixels
+    :param height:
+    :return:
+    """
+    return np.max(y) if len(y) else height - 1
@@ -0,0 +1,328 @@
+import argparse
+import asyncio
+import json
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import config
+import main
+
+
+# Lane detection service for several cameras at once. Each camera is one
+# connection (TCP on localhost, or a unix socket) and gets its own Pipeline, so
+# temporal lane state never mixes between streams. Frames of a stream are
+# processed in order, one at a time; frames of different streams run side by
+# side on a shared thread pool (OpenCV and numpy release the GIL).
+#
+# Protocol, all integers big-endian:
+#   client -> server  hello: uint32 length + JSON {"stream": name}
+#                     frame: uint32 index, uint16 height, uint16 width + height*width*3 RGB bytes
+#                     EOF ends the stream
+#   server -> client  uint32 length + JSON Pipeline.last_result plus "index" and "latency_ms"
+#
+# A hello of {"stats": true} instead returns the per-stream metrics and closes.
+#
+# Backpressure: every stream reads at most queue_size frames ahead. When its
+# queue is full the server stops reading the socket, the kernel buffers fill up
+# and the client's writer.drain() blocks, so a slow stream only slows its own
+# camera. Fairness: a stream waits for a pool slot with at most one frame, and
+# asyncio.Semaphore wakes waiters first come first served, so busy streams
+# take turns instead of one stream starving the others.
+
+FRAME_HEADER = struct.Struct('!IHH')
+LENGTH = struct.Struct('!I')
+
+
+async def read_message(reader):
+    """
+    :param reader: asyncio.StreamReader
+    :return: a length prefixed JSON message, None at EOF
+    """
+    try:
+        length, = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+        return json.loads((await reader.readexactly(length)).decode('utf-8'))
+    except asyncio.IncompleteReadError:
+        return None
+
+
+def write_message(writer, message):
+    data = json.dumps(message).encode('utf-8')
+    writer.write(LENGTH.pack(len(data)) + data)
+
+
+async def read_frame(reader):
+    """
+    :param reader: asyncio.StreamReader
+    :return: (index, RGB frame), None at EOF
+    """
+    try:
+        index, h, w = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+        data = await reader.readexactly(h * w * 3)
+    except asyncio.IncompleteReadError:
+        return None
+    return index, np.frombuffer(data, dtype=np.uint8).reshape(h, w, 3)
+
+
+def write_frame(writer, index, frame):
+    h, w = frame.shape[:2]
+    writer.write(FRAME_HEADER.pack(index, h, w))
+    writer.write(np.ascontiguousarray(frame, dtype=np.uint8).reshape(-1).data)
+
+
+class StreamState(object):
+    def __init__(self, name, queue_size):
+        """
+        :param name: stream name from the hello message
+        :param queue_size: frames read ahead before the socket is no longer read
+        """
+        self.name = name
+        # Only the lane geometry goes back to the client, nothing is drawn
+        self.pipeline = main.Pipeline(render=False)
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.received = 0
+        self.processed = 0
+        self.backpressure_waits = 0
+        self.errors = 0
+        self.started = None
+        self.finished = None
+        self.latencies = []
+
+    def stats(self):
+        """
+        :return: dict of frame counts, queue depth, throughput and latency percentiles
+        """
+        stats = {'received': self.received,
+                 'processed': self.processed,
+                 'queued': self.queue.qsize(),
+                 'backpressure_waits': self.backpressure_waits,
+                 'errors': self.errors,
+                 'done': self.finished is not None}
+        if self.processed:
+            elapsed = (self.finished or time.perf_counter()) - self.started
+            stats['fps'] = self.processed / elapsed if elapsed > 0 else 0.
+            p50, p95, p99 = np.percentile(np.array(self.latencies) * 1000, [50, 95, 99])
+            stats.update({'latency_p50_ms': float(p50), 'latency_p95_ms': float(p95), 'latency_p99_ms': float(p99)})
+        return stats
+
+
+class LaneServer(object):
+    def __init__(self, workers=None, queue_size=None):
+        """
+        :param workers: threads running Pipeline.main for all streams, defaults to one per core
+        :param queue_size: frames read ahead per stream
+        """
+        self.workers = workers or config.server_configs['workers'] or os.cpu_count() or 1
+        self.queue_size = queue_size or config.server_configs['queue_size']
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.slots = None
+        self.streams = {}
+        self.server = None
+
+    async def start(self, host=None, port=None, path=None):
+        """
+        Listen on a unix socket when path is given, on host:port otherwise
+        :param host:
+        :param port: 0 picks a free port, see address
+        :param path:
+        :return:
+        """
+        self.slots = asyncio.Semaphore(self.workers)
+        if path:
+            self.server = await asyncio.start_unix_server(self.handle, path=path)
+        else:
+            host = host or config.server_configs['host']
+            port = config.server_configs['port'] if port is None else port
+            self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    @property
+    def address(self):
+        return self.server.sockets[0].getsockname()
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.executor.shutdown()
+
+    async def handle(self, reader, writer):
+        hello = await read_message(reader)
+        if hello is None:
+            writer.close()
+            return
+        if hello.get('stats'):
+            write_message(writer, self.stats())
+            await writer.drain()
+            writer.close()
+            return
+        name = str(hello.get('stream', len(self.streams)))
+        if name in self.streams and self.streams[name].finished is None:
+            write_message(writer, {'error': 'stream {0} is already connected'.format(name)})
+            await writer.drain()
+            writer.close()
+            return
+        state = StreamState(name, self.queue_size)
+        self.streams[name] = state
+        worker = asyncio.ensure_future(self.process_stream(state, writer))
+        try:
+            while True:
+                item = await read_frame(reader)
+                if item is None:
+                    break
+                state.received += 1
+                if state.queue.full():
+                    state.backpressure_waits += 1
+                await state.queue.put((item, time.perf_counter()))
+        finally:
+            await state.queue.put(None)
+            await worker
+            state.finished = time.perf_counter()
+            writer.close()
+
+    async def process_stream(self, state, writer):
+        """
+        Run the stream's frames through its Pipeline in order and reply with the lane geometry
+        :param state: StreamState
+        :param writer: asyncio.StreamWriter of the stream's connection
+        :return:
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            item = await state.queue.get()
+            if item is None:
+                return
+            (index, frame), received_at = item
+            if state.started is None:
+                state.started = received_at
+            try:
+                async with self.slots:
+                    await loop.run_in_executor(self.executor, state.pipeline.main, frame)
+                result = dict(state.pipeline.last_result or {})
+            except Exception as e:
+                # A bad frame is reported and skipped, the stream goes on
+                state.errors += 1
+                result = {'error': '{0}: {1}'.format(type(e).__name__, e)}
+            latency = time.perf_counter() - received_at
+            result.update({'index': index, 'latency_ms': latency * 1000})
+            state.processed += 1
+            state.latencies.append(latency)
+            del state.latencies[:-config.profile_configs['window']]
+            write_message(writer, result)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    def stats(self):
+        """
+        :return: {stream name: stats} for every stream seen so far
+        """
+        return dict((name, state.stats()) for name, state in self.streams.items())
+
+
+async def synthetic_client(name, frames, host=None, port=None, path=None):
+    """
+    Send frames as one stream and collect the replies
+    :param name: stream name
+    :param frames: iterable of RGB frames, e.g. benchmark.synthetic_frames
+    :param host:
+    :param port:
+    :param path: unix socket path, overrides host and port
+    :return: list of result dicts, in frame order
+    """
+    if path:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection(host or config.server_configs['host'],
+                                                       port or config.server_configs['port'])
+    write_message(writer, {'stream': name})
+
+    async def send():
+        for index, frame in enumerate(frames):
+            write_frame(writer, index, frame)
+            await writer.drain()
+        writer.write_eof()
+
+    sender = asyncio.ensure_future(send())
+    results = []
+    while True:
+        result = await read_message(reader)
+        if result is None:
+            break
+        results.append(result)
+    await sender
+    writer.close()
+    return results
+
+
+async def demo(streams, frames, workers=None, queue_size=None, path=None):
+    """
+    Serve on a free local port (or a unix socket) and push synthetic streams through it
+    :param streams: number of concurrent synthetic cameras
+    :param frames: frames per camera
+    :param workers:
+    :param queue_size:
+    :param path:
+    :return: the server's per-stream stats
+    """
+    import benchmark
+    w, h = config.calibration_size
+    server = LaneServer(workers=workers, queue_size=queue_size)
+    await server.start(port=0, path=path)
+    host, port = (None, None) if path else server.address[:2]
+    videos = [benchmark.synthetic_frames(w, h, frames, seed=i) for i in range(streams)]
+    start = time.perf_counter()
+    results = await asyncio.gather(*[synthetic_client('camera{0}'.format(i), video, host, port, path)
+                                     for i, video in enumerate(videos)])
+    elapsed = time.perf_counter() - start
+    await server.close()
+    for i, stream_results in enumerate(results):
+        assert [r['index'] for r in stream_results] == list(range(frames)), 'stream {0} lost frames'.format(i)
+    stats = server.stats()
+    stats['total'] = {'frames': streams * frames, 'seconds': elapsed, 'fps': streams * frames / elapsed}
+    return stats
+
+
+async def serve(host=None, port=None, path=None, workers=None, queue_size=None):
+    server = LaneServer(workers=workers, queue_size=queue_size)
+    await server.start(host=host, port=port, path=path)
+    print('Serving on {0} with {1} workers'.format(path or server.address, server.workers))
+    async with server.server:
+        await server.server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Lane detection service for several camera streams')
+    parser.add_argument('command', choices=['serve', 'demo', 'stats'])
+    parser.add_argument('--host', default=None)
+    parser.add_argument('--port', type=int, default=None)
+    parser.add_argument('--unix', default=None, help='unix socket path instead of TCP')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--queue-size', type=int, default=None)
+    parser.add_argument('--streams', type=int, default=4, help='demo: synthetic cameras')
+    parser.add_argument('--frames', type=int, default=50, help='demo: frames per camera')
+    parser.add_argument('--config', help='JSON config overrides, reloaded while running when the file changes')
+    args = parser.parse_args()
+    if args.config:
+        import live_config
+        live_config.load(args.config)
+    if args.command == 'serve':
+        asyncio.run(serve(args.host, args.port, args.unix, args.workers, args.queue_size))
+    elif args.command == 'demo':
+        print(json.dumps(asyncio.run(demo(args.streams, args.frames, args.workers, args.queue_size, args.unix)),
+                         indent=2))
+    else:
+        async def query():
+            if args.unix:
+                reader, writer = await asyncio.open_unix_connection(args.unix)
+            else:
+                reader, writer = await asyncio.open_connection(args.host or config.server_configs['host'],
+                                                               args.port or config.server_configs['port'])
+            write_message(writer, {'stats': True})
+            message = await read_message(reader)
+            writer.close()
+            return message
+        print(json.dumps(asyncio.run(query()), indent=2))
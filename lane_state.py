@@ -0,0 +1,126 @@
+import numpy as np
+
+import config
+
+GOOD = 0
+WIDE = 1
+NARROW = 2
+
+
+def classify(left, right):
+    """
+    Lane width check that sorts frames into good, wide and narrow lanes
+    :param left: leftx base
+    :param right: rightx base
+    :return: GOOD, WIDE or NARROW
+    """
+    if abs(left - right) > config.lane_configs['max_width']:
+        return WIDE
+    elif abs(left - right) < config.lane_configs['min_width']:
+        return NARROW
+    return GOOD
+
+
+class LaneHistory(object):
+    def __init__(self, capacity=None, nwindows=None, smooth_frames=None):
+        """
+        Fixed capacity temporal lane state: preallocated ring buffers of
+        per-frame base positions, pixel-space fits and window centers.
+        Once full, each new frame overwrites the oldest one, so memory stays
+        constant however long the stream runs.
+        :param capacity: frames kept
+        :param nwindows: sliding windows per frame, for the window center buffer
+        :param smooth_frames: trusted fits averaged by smoothed_fits
+        """
+        self.capacity = capacity or config.history_configs['capacity']
+        nwindows = nwindows or config.hist_configs['nwindows']
+        self.smooth_frames = smooth_frames or config.history_configs['smooth_frames']
+        self.frame_nums = np.zeros(self.capacity, dtype=np.int64)
+        self.bases = np.zeros((self.capacity, 2), dtype=np.int32)
+        self.fits = np.zeros((self.capacity, 2, 3))
+        # nwindows recenters plus the base, -1 where a window did not recenter
+        self.windows = np.full((self.capacity, 2, nwindows + 1), -1, dtype=np.int32)
+        self.status = np.zeros(self.capacity, dtype=np.int8)
+        self.trusted = np.zeros(self.capacity, dtype=bool)
+        self.count = 0
+        self._last_good = -1
+        self._trusted_slots = np.full(self.smooth_frames, -1, dtype=np.int64)
+        self._trusted_count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def push(self, frame_num, bases, fits, windows=None, trusted=False):
+        """
+        Record one frame
+        :param frame_num:
+        :param bases: (leftx_base, rightx_base)
+        :param fits: (left_fit, right_fit) pixel space, or None
+        :param windows: (leftx_current_lst, rightx_current_lst)
+        :param trusted: whether the fits passed the confidence check, only trusted fits are smoothed
+        :return: the frame's status
+        """
+        slot = self.count % self.capacity
+        self.frame_nums[slot] = frame_num
+        self.bases[slot] = bases
+        self.status[slot] = classify(bases[0], bases[1])
+        self.trusted[slot] = trusted and fits is not None
+        if fits is not None:
+            self.fits[slot] = fits
+        self.windows[slot] = -1
+        if windows is not None:
+            for lane, centers in enumerate(windows):
+                centers = centers[:self.windows.shape[2]]
+                self.windows[slot, lane, :len(centers)] = centers
+        if self.status[slot] == GOOD:
+            self._last_good = self.count
+        if self.trusted[slot]:
+            self._trusted_slots[self._trusted_count % self.smooth_frames] = self.count
+            self._trusted_count += 1
+        self.count += 1
+        return self.status[slot]
+
+    def _in_buffer(self, index):
+        return index >= 0 and index > self.count - 1 - self.capacity
+
+    def last_good_lane(self):
+        """
+        :return: [leftx_base, rightx_base] of the most recent good frame still in the buffer, or None
+        """
+        if not self._in_buffer(self._last_good):
+            return None
+        return self.bases[self._last_good % self.capacity].tolist()
+
+    def smoothed_fits(self):
+        """
+        Mean of the last smooth_frames trusted fits
+        :return: (left_fit, right_fit) or None when no trusted fit is in the buffer
+        """
+        recent = [i for i in self._trusted_slots[:min(self._trusted_count, self.smooth_frames)]
+                  if self._in_buffer(i)]
+        if not recent:
+            return None
+        mean = self.fits[np.array(recent) % self.capacity].mean(axis=0)
+        return mean[0], mean[1]
+
+    def recent(self, status=None):
+        """
+        Slots of the frames still in the buffer, oldest first
+        :param status: only frames with this status
+        :return:
+        """
+        n = len(self)
+        slots = (np.arange(self.count - n, self.count)) % self.capacity
+        if status is not None:
+            slots = slots[self.status[slots] == status]
+        return slots
+
+    def reset_trusted(self):
+        """Forget the trusted fits, e.g. when the tracker has lost the lanes"""
+        self._trusted_count = 0
+
+    def clear(self):
+        """Forget every frame, keeping the buffers"""
+        self.count = 0
+        self._last_good = -1
+        self.reset_trusted()
@@ -0,0 +1,198 @@
+import functools
+import json
+import numbers
+import os
+import sys
+import time
+
+import config
+
+
+# Versioned, hot reloadable view of the config dicts. Every *_configs dict of
+# config.py is a section with its own version, bumped whenever update() or
+# load() changes one of its values (the dicts are updated in place, so every
+# config.x_configs[...] read sees the new value). Values derived from the
+# config (warp matrices, remap tables, threshold lookup tables, window layouts)
+# are memoized with derived() against the contents of the sections they read,
+# see key(), and rebuilt lazily on first use after one of those sections changed.
+# Keying on the contents rather than the versions means a plain
+# config.x_configs['key'] = value assignment is picked up as well.
+#
+# A config file is JSON of {section: {key: value}}, only the keys to override:
+#   {"threshold_configs": {"sobel_min": 25}, "hist_configs": {"nwindows": 12}}
+# After load(path) the file is watched and maybe_reload() (called by
+# Pipeline.main) picks up changes at most every reload_configs['interval'] seconds.
+# Values are checked against the type of the value config.py starts with (ints
+# stay ints, lists and tuples are interchangeable, a None default takes anything)
+# before anything is applied, and a file that fails the check is reported and
+# ignored while running, so a bad edit cannot stop a stream.
+
+_versions = {}
+# Values of config.py as imported, the types updates are checked against
+_defaults = dict((name, dict(value)) for name, value in vars(config).items()
+                 if name.endswith('_configs') and isinstance(value, dict))
+_watched = {'path': None, 'mtime': None, 'checked': 0.}
+
+
+def sections():
+    """
+    :return: names of the config dicts that can be updated
+    """
+    return sorted(name for name, value in vars(config).items()
+                  if name.endswith('_configs') and isinstance(value, dict))
+
+
+def version(*names):
+    """
+    :param names: section names
+    :return: tuple of their versions, 0 until a section first changes
+    """
+    return tuple(_versions.get(name, 0) for name in names)
+
+
+def key(*names):
+    """
+    Hashable snapshot of the contents of sections, a handful of small values each
+    :param names: section names
+    :return: tuple of one sorted (key, value) tuple per section
+    """
+    return tuple(_freeze(getattr(config, name)) for name in names)
+
+
+def _freeze(value):
+    """Hashable copy of a config value, lists (e.g. from a JSON file) become tuples"""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _same_kind(default, value):
+    """Whether value can replace default without breaking the code that reads it"""
+    if default is None:
+        return True
+    if isinstance(default, bool) or isinstance(value, bool):
+        return isinstance(default, bool) and isinstance(value, bool)
+    if isinstance(default, numbers.Integral):
+        return isinstance(value, numbers.Integral)
+    if isinstance(default, numbers.Real):
+        return isinstance(value, numbers.Real)
+    if isinstance(default, (list, tuple)):
+        return isinstance(value, (list, tuple))
+    return isinstance(value, type(default))
+
+
+def check(section, values, source=None):
+    """
+    Raise ValueError unless values can be applied to a section
+    :param section: e.g. 'threshold_configs'
+    :param values: dict of keys that must already exist in the section, with values of the same type
+    :param source: file the values come from, for the message
+    :return:
+    """
+    where = ' of {0}'.format(source) if source else ''
+    if section not in sections():
+        raise ValueError('Unknown config section {0}{1}'.format(section, where))
+    if not isinstance(values, dict):
+        raise ValueError('{0}{1} is not a dict of values but {2!r}'.format(section, where, values))
+    current = getattr(config, section)
+    unknown = set(values) - set(current)
+    if unknown:
+        raise ValueError('Unknown keys {0} in {1}{2}'.format(sorted(unknown), section, where))
+    defaults = _defaults.get(section, current)
+    for k, v in sorted(values.items()):
+        default = defaults.get(k, current[k])
+        if not _same_kind(default, v):
+            raise ValueError('{0}[{1!r}]{2} is {3!r}, expected a value like {4!r}'.format(
+                section, k, where, v, default))
+
+
+def update(section, **values):
+    """
+    Change values of one section in place
+    :param section: e.g. 'threshold_configs'
+    :param values: keys must already exist in the section, values must be of the same type, see check()
+    :return: True when a value actually changed (and the version was bumped)
+    """
+    check(section, values)
+    current = getattr(config, section)
+    changed = dict((k, v) for k, v in values.items() if current[k] != v)
+    if changed:
+        current.update(changed)
+        _versions[section] = _versions.get(section, 0) + 1
+    return bool(changed)
+
+
+def load(path):
+    """
+    Apply a JSON config file and watch it for changes. Every section is checked
+    before any value is applied, so a bad file changes nothing.
+    :param path:
+    :return: names of the sections that changed
+    """
+    with open(path) as f:
+        overrides = json.load(f)
+    if not isinstance(overrides, dict):
+        raise ValueError('{0} is not a dict of config sections'.format(path))
+    for section, values in overrides.items():
+        check(section, values, path)
+    _watched.update({'path': path, 'mtime': os.stat(path).st_mtime, 'checked': time.perf_counter()})
+    return [section for section, values in sorted(overrides.items()) if update(section, **values)]
+
+
+def maybe_reload():
+    """
+    Reload the watched config file when it changed on disk. Cheap enough to
+    call every frame: the file is only stat'ed every reload_configs['interval'] seconds.
+    A file that cannot be read, does not parse or fails check() is reported on
+    stderr and skipped, the running config stays as it was.
+    :return: names of the sections that changed
+    """
+    path = _watched['path']
+    if path is None:
+        return []
+    now = time.perf_counter()
+    if now - _watched['checked'] < config.reload_configs['interval']:
+        return []
+    _watched['checked'] = now
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return []
+    if mtime == _watched['mtime']:
+        return []
+    try:
+        changed = load(path)
+    except Exception as e:
+        # Whatever is wrong with the file, the stream keeps running on the config it has
+        _watched['mtime'] = mtime
+        print('Ignoring config file {0}: {1}: {2}'.format(path, type(e).__name__, e), file=sys.stderr)
+        return []
+    if changed:
+        print('Reloaded {0} from {1}'.format(', '.join(changed), path), file=sys.stderr)
+    return changed
+
+
+def derived(*names):
+    """
+    Memoize a function of hashable arguments against the contents of the config
+    sections it reads, e.g. @derived('hist_configs')
+    :param names: section names
+    :return: decorator
+    """
+    def decorator(fn):
+        cache = {}
+
+        @functools.wraps(fn)
+        def wrapper(*args):
+            memo_key = key(*names) + args
+            value = cache.get(memo_key)
+            if value is None:
+                if len(cache) >= config.reload_configs['max_cache_entries']:
+                    cache.clear()
+                value = cache[memo_key] = fn(*args)
+            return value
+        wrapper.cache = cache
+        return wrapper
+    return decorator
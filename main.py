@@ -1,48 +1,252 @@
+import sys
+import time
+
 import cv2
+import numpy as np
 
 import config
 import draw_lanes
 import histogram_img_search
+import lane_model
+import lane_state
+import live_config
 import persp_transform
+import profiling
 import thresholds
 
 
+# Pipeline.main modes, from full detection to cheapest
+FULL = 'full'
+LOOKAHEAD = 'lookahead'
+REUSE = 'reuse'
+# Set by the skip cache on last_result, not a mode to ask for
+SKIP = 'skip'
+
+
 class Pipeline(object):
     def __init__(self, override_calibration=False, test_img='test_images/straight_lines1.jpg',
-                 save_pipeline=False):
+                 save_pipeline=False, lookahead=True,
+                 threshold_roi=False, profile=False, render_mode=None,
+                 detection_scale=None, adaptive_resolution=None, undistort_roi=None, render=None,
+                 skip_static=None):
         if not override_calibration:
             self.mtx = config.mtx
             self.dist = config.dist
         else:
             import calibrate_camera
-            # Compute the camera calibration matrix and distortion coefficients given a set of chessboard images.
-            c = calibrate_camera.Calibrate()
-            self.mtx, self.dist = c.calibrate()
+            calibration = calibrate_camera.load_calibration()
+            if calibration is None:
+                # Compute the camera calibration matrix and distortion coefficients given a set of chessboard images.
+                c = calibrate_camera.Calibrate()
+                calibration = c.calibrate()
+            self.mtx, self.dist = calibration
         self.test_img = test_img
-        self.lcurve_currents = {}
-        self.rcurve_currents = {}
-        self.good_lanes = []
-        self.wide_lanes = []
-        self.narrow_lanes = []
+        # Bounded per-frame lane state: bases, fits and window centers
+        self.history = lane_state.LaneHistory()
         self.save_pipeline = save_pipeline
         self.frame_num = 1
+        self.geometry = None
+        # Look-ahead tracking state: last trusted pixel-space fits
+        self.lookahead = lookahead
+        self.left_fit = None
+        self.right_fit = None
+        self.lookahead_failures = 0
+        # Only threshold the part of the birds-eye view the perspective configs keep
+        self.threshold_roi = threshold_roi
+        self.render_mode = render_mode or config.render_configs['mode']
+        # False skips the overlay and the text, main only fills last_result and returns None
+        self.render = config.render_configs['render'] if render is None else render
+        # Threshold and search on a scaled birds-eye view, fits stay in full resolution pixels
+        self.detection_scale = detection_scale or config.resolution_configs['scale']
+        if adaptive_resolution is None:
+            adaptive_resolution = config.resolution_configs['adaptive']
+        self.resolution = None
+        if adaptive_resolution:
+            import resolution
+            self.resolution = resolution.ResolutionController()
+        self.undistort_roi = config.resolution_configs['undistort_roi'] if undistort_roi is None else undistort_roi
+        self.last_trusted = False
+        # Own threshold buffers, so Pipelines on different threads never share a mask
+        self.threshold_engine = thresholds.ThresholdEngine()
+        # Lane geometry of the last processed frame, see record_result
+        self.last_result = None
+        # Camera space lane polygon of the last overlay, reused by skipped frames
+        self.last_polygon = None
+        # Reuse the last frame's lanes while the road does not change, see change_detector
+        if skip_static is None:
+            skip_static = config.skip_configs['enabled']
+        self.skip_cache = None
+        if skip_static:
+            import change_detector
+            self.skip_cache = change_detector.ChangeDetector()
+        # Per-stage latency, a no-op unless profile is set
+        self.timer = profiling.StageTimer(enabled=profile)
+
+    @property
+    def good_lanes(self):
+        """Bases of the good frames still held in the history, oldest first"""
+        return self.history.bases[self.history.recent(lane_state.GOOD)].tolist()
+
+    @property
+    def wide_lanes(self):
+        return self.history.bases[self.history.recent(lane_state.WIDE)].tolist()
+
+    @property
+    def narrow_lanes(self):
+        return self.history.bases[self.history.recent(lane_state.NARROW)].tolist()
+
+    def last_good_lane(self, height):
+        """
+        Bases the sliding window search falls back to: where the smoothed
+        fits meet the bottom of the image, or the last good frame's bases
+        :param height:
+        :return:
+        """
+        smoothed = self.history.smoothed_fits()
+        if smoothed is None:
+            return self.history.last_good_lane()
+        return [int(np.polyval(smoothed[0], height - 1)), int(np.polyval(smoothed[1], height - 1))]
 
-    def save_lanes(self, left, right):
+    def get_geometry(self, img):
         """
-        Save lanes for videos, so we can use previous lane
-        if/when we run into a bad image
+        Undistort/warp lookup tables for this frame size, built once per stream
+        and again when the perspective configs change
         :param img:
-        :param good_lane:
         :return:
         """
-        if abs(left - right) > config.lane_configs['max_width']:
-            self.wide_lanes.append([left, right])
-        elif abs(left - right) < config.lane_configs['min_width']:
-            self.narrow_lanes.append([left, right])
+        h, w = img.shape[:2]
+        return self.geometry_for(w, h)
+
+    def geometry_for(self, w, h):
+        """
+        get_geometry by frame size
+        :param w:
+        :param h:
+        :return:
+        """
+        if self.geometry is None or self.geometry.size != (w, h):
+            self.geometry = persp_transform.get_geometry(w, h, self.mtx, self.dist)
+        elif self.geometry.config_key != live_config.key('perspect_configs'):
+            # The birds-eye view moved, fits tracked in the old one are meaningless
+            self.geometry = persp_transform.get_geometry(w, h, self.mtx, self.dist)
+            self.left_fit, self.right_fit = None, None
+            self.lookahead_failures = 0
+            self.history.reset_trusted()
+            if self.skip_cache is not None:
+                self.skip_cache.reset()
+        return self.geometry
+
+    def reset(self):
+        """
+        Forget the temporal lane state, as for the first frame of a new stream or
+        an unrelated image, but keep the geometry and buffers built so far
+        :return:
+        """
+        self.history.clear()
+        self.frame_num = 1
+        self.left_fit, self.right_fit = None, None
+        self.lookahead_failures = 0
+        self.last_trusted = False
+        self.last_result = None
+        self.last_polygon = None
+        if self.skip_cache is not None:
+            self.skip_cache.reset()
+
+    def prepare(self, w, h):
+        """
+        Build the tables a first frame of this size would otherwise pay for,
+        without processing a frame: the geometry and scaled remap tables, the
+        threshold buffers and lookup table and the sliding window layout
+        :param w:
+        :param h:
+        :return:
+        """
+        geometry = self.geometry_for(w, h)
+        scale = self.resolution.scale if self.resolution is not None else self.detection_scale
+        geometry.scaled_warp_maps(scale)
+        scaled_w, scaled_h = geometry.scaled_size(scale)
+        self.threshold_engine.buffers((scaled_h, scaled_w))
+        if self.threshold_roi:
+            x0, y0, x1, y1 = geometry.scaled_roi(scale)
+            self.threshold_engine.buffers((y1 - y0, x1 - x0))
+        thresholds.sobel_bounds()
+        histogram_img_search.window_layout(scaled_h, scale)
+
+    def find_lanes(self, thresh, scale=1.0, full_search=True):
+        """
+        Search around the (smoothed) previous fits when we have them, and only
+        go back to the full histogram + sliding window search after
+        max_lookahead_failures frames in a row fail the confidence check.
+        In between, the failing frame reuses the previous fits.
+        :param thresh:
+        :param scale: size of thresh relative to the full resolution birds-eye view
+        :param full_search: False never falls back to the full search while there are fits to track
+        :return: found, fits, trusted: found is the get_window_for_lane tuple, fits the frame's
+                 pixel-space (left_fit, right_fit) or None, trusted whether it passed the confidence check
+        """
+        height = int(round(thresh.shape[0] / scale))
+        if self.lookahead and self.left_fit is not None:
+            prior = self.history.smoothed_fits() or (self.left_fit, self.right_fit)
+            # Bases come from this frame's fits, so the width check tests this frame's detection
+            found, fits = histogram_img_search.lookahead_search(thresh, prior[0], prior[1], scale=scale)
+            polys, leftx, lefty, rightx, righty, leftx_base, rightx_base = found[:7]
+            if fits is not None and \
+                    histogram_img_search.is_confident(leftx, rightx, leftx_base, rightx_base, scale=scale):
+                self.lookahead_failures = 0
+                self.left_fit, self.right_fit = fits
+                return self.with_curvature(found, fits, height), fits, True
+            self.lookahead_failures += 1
+            if self.lookahead_failures < config.hist_configs['max_lookahead_failures'] or not full_search:
+                leftx, lefty = histogram_img_search.points_from_fit(prior[0], height)
+                rightx, righty = histogram_img_search.points_from_fit(prior[1], height)
+                left_curve, right_curve = lane_model.curvature(np.array(prior), height - 1)
+                leftx_base, rightx_base = int(np.polyval(prior[0], height - 1)), int(np.polyval(prior[1], height - 1))
+                return (polys, leftx, lefty, rightx, righty, leftx_base, rightx_base, left_curve, right_curve,
+                        [leftx_base], [rightx_base]), prior, False
+        found = histogram_img_search.get_window_for_lane(
+            thresh, last_good_lane=self.last_good_lane(height), timer=self.timer, scale=scale, curvature=False)
+        polys, leftx, lefty, rightx, righty, leftx_base, rightx_base = found[:7]
+        self.lookahead_failures = 0
+        fits = self.fit_lanes(found)
+        found = self.with_curvature(found, fits, height)
+        if histogram_img_search.is_confident(leftx, rightx, leftx_base, rightx_base, scale=scale):
+            self.left_fit, self.right_fit = fits
+            return found, fits, True
+        self.left_fit, self.right_fit = None, None
+        self.history.reset_trusted()
+        return found, fits, False
+
+    @staticmethod
+    def fit_lanes(found):
+        """
+        Pixel-space fits of a search result
+        :param found: get_window_for_lane tuple
+        :return: (left_fit, right_fit), None when a lane has too few pixels to fit
+        """
+        leftx, lefty, rightx, righty = found[1:5]
+        if len(lefty) < 3 or len(righty) < 3:
+            return None
+        fits = lane_model.fit_batch([lefty, righty], [leftx, rightx])
+        return fits[0], fits[1]
+
+    def with_curvature(self, found, fits, height):
+        """
+        Fill in the curvatures of a search run with curvature=False from the
+        frame's fits, so every lane is fitted once per frame
+        :param found: get_window_for_lane tuple
+        :param fits: (left_fit, right_fit) or None
+        :param height: full resolution birds-eye view height
+        :return: found with left_curve, right_curve set, inf without fits
+        """
+        if fits is None:
+            curves = (np.inf, np.inf)
         else:
-            self.good_lanes.append([left, right])
+            with self.timer.stage('curvature'):
+                curves = tuple(lane_model.curvature(np.array(fits), [lane_model.lane_bottom(found[2], height),
+                                                                     lane_model.lane_bottom(found[4], height)]))
+        return found[:7] + curves + found[9:]
 
-    def main(self, img=None):
+    def main(self, img=None, mode=FULL, undistorted=None, warped=None):
         """
         Use color transforms, gradients, etc., to create a thresholded binary image.
         Apply a perspective transform to rectify binary image ("birds-eye view").
@@ -89,58 +293,296 @@ class Pipeline(object):
           d) check for perspective changes
 
         First quantity (ensure i have data, if not get from past frame), then quality (ensure they are compatible, first with each other then with previous frame)
-        :return:
+        :param img:
+        :param mode: FULL, LOOKAHEAD (never run the full histogram search while tracking)
+                     or REUSE (skip detection and draw the last trusted fits)
+        :param undistorted: img already undistorted, e.g. from a frame_store.FrameStore
+        :param warped: img already warped to the birds-eye view at the detection scale
+        :return: annotated frame, None when not rendering (the lane geometry is in last_result)
         """
 
         if img is None:
             img = cv2.imread(self.test_img)
-        # Apply a distortion correction to raw images.
-        undistorted = cv2.undistort(img, self.mtx, self.dist, None, self.mtx)
-        # Perspective Transform
-        persp = persp_transform.get_warped_perspective(undistorted)
+        live_config.maybe_reload()
+        start = time.perf_counter()
+        with self.timer.stage('frame'):
+            out_img = self.process(img, mode=mode, undistorted=undistorted, warped=warped)
+        if self.resolution is not None:
+            self.resolution.update(time.perf_counter() - start, self.last_trusted)
+        self.frame_num += 1
+        if self.save_pipeline and out_img is not None:
+            cv2.imwrite('out_img.png', out_img)
+        return out_img
+
+    def tracked_fits(self):
+        """
+        :return: the smoothed or last trusted (left_fit, right_fit), None when not tracking
+        """
+        if self.left_fit is None:
+            return None
+        return self.history.smoothed_fits() or (self.left_fit, self.right_fit)
+
+    def process(self, img, mode=FULL, undistorted=None, warped=None):
+        """
+        One frame through every stage, see main
+        :param img:
+        :param mode:
+        :param undistorted: optional precomputed undistorted img
+        :param warped: optional precomputed birds-eye view of img, only used when
+                       its size matches the detection scale of this frame
+        :return:
+        """
+        geometry = self.get_geometry(img)
+        timer = self.timer
+        scale = self.resolution.scale if self.resolution is not None else self.detection_scale
+        skip = False
+        if self.skip_cache is not None and mode != REUSE:
+            with timer.stage('change_detect'):
+                skip = self.skip_cache.check(img, geometry, reusable=self.last_result is not None and
+                                             self.last_result['left_fit'] is not None)
+        # Apply a distortion correction to raw images, only needed to draw on
+        if not self.render:
+            undistorted = None
+        elif undistorted is None:
+            with timer.stage('undistort'):
+                undistorted = geometry.undistort(img, roi_only=self.undistort_roi)
+        if skip:
+            return self.replay(undistorted, geometry)
+        if self.skip_cache is not None:
+            self.skip_cache.keep()
+        fits = self.tracked_fits() if mode == REUSE else None
+        if fits is not None:
+            # Degraded frame: no detection, the lanes are the ones we are tracking
+            self.last_trusted = False
+            left_curve, right_curve = histogram_img_search.get_center_radius_from_fits(np.array(fits), img.shape[0] - 1)
+            out_img, center = self.draw(None, undistorted, None, fits, geometry)
+            bottom = img.shape[0] - 1
+            self.record_result(mode, False, fits, left_curve, right_curve, center,
+                               (np.polyval(fits[0], bottom), np.polyval(fits[1], bottom)))
+            self.annotate(out_img, left_curve, right_curve, center)
+            return out_img
+        # Perspective Transform, straight from the raw frame with the composed remap table
+        persp = warped
+        if persp is None or persp.shape[:2] != geometry.scaled_size(scale)[::-1]:
+            with timer.stage('warp'):
+                persp = geometry.undistort_and_warp(img, scale=scale)
         # Thresholding
-        thresh = thresholds.pipeline(persp)
+        with timer.stage('threshold'):
+            thresh = self.threshold_engine.pipeline(persp, roi=geometry.scaled_roi(scale) if self.threshold_roi else None)
         if self.save_pipeline:
             cv2.imwrite('thresh.png', thresh)
-        polys, leftx, lefty, rightx, righty, leftx_base, rightx_base, left_curve, right_curve, leftx_current_lst, rightx_current_lst \
-            = histogram_img_search.get_window_for_lane(thresh,
-                                                       last_good_lane=self.good_lanes[-1] if self.good_lanes else None)
-        self.lcurve_currents[self.frame_num] = leftx_current_lst
-        self.rcurve_currents[self.frame_num] = rightx_current_lst
+        with timer.stage('lane_search'):
+            found, fits, trusted = self.find_lanes(thresh, scale=scale, full_search=mode == FULL)
+        self.last_trusted = trusted
+        polys, leftx, lefty, rightx, righty, leftx_base, rightx_base, left_curve, right_curve, \
+            leftx_current_lst, rightx_current_lst = found
         if self.save_pipeline:
-            print(leftx)
-            print(rightx)
+            print(leftx, file=sys.stderr)
+            print(rightx, file=sys.stderr)
             cv2.imwrite('polys.png', polys)
         #
         # Do a histogram search
-        self.save_lanes(leftx_base, rightx_base)
-        out_img, center = draw_lanes.draw_on_orig(thresh, undistorted, leftx, lefty, rightx, righty)
+        self.history.push(self.frame_num, (leftx_base, rightx_base), fits,
+                          windows=(leftx_current_lst, rightx_current_lst), trusted=trusted)
+        out_img, center = self.draw(thresh, undistorted, found, self.history.smoothed_fits() or fits, geometry)
+        self.record_result(mode, trusted, self.history.smoothed_fits() or fits, left_curve, right_curve, center,
+                           (leftx_base, rightx_base), windows=(leftx_current_lst, rightx_current_lst))
         # left_search_x, right_search_x = self.correct_bad_lanes(left_search_x, right_search_x)
         # Print curvature and center offset on an image
-        stats_text = 'Curvature: {0}, Dist From Center: {1}, Frame: {2}'.format(
-            int((left_curve + right_curve) / 2), round(center*3.7/700,1), self.frame_num)
+        self.annotate(out_img, left_curve, right_curve, center)
+        return out_img
+
+    def process_batch(self, frames):
+        """
+        Annotate an (N, H, W, 3) batch of consecutive frames, amortizing the
+        per-frame Python overhead: histogram bases are found for the whole
+        batch at once and every lane fit of the batch is one batched
+        least-squares solve instead of np.polyfit calls.
+        The look-ahead search needs the previous frame's fit, so inside a batch
+        every frame gets the sliding window search, falling back to the last
+        good bases as of the previous frame. The history and its smoothed fits
+        are still updated frame by frame in order, and the look-ahead state is
+        left ready for the next main() call. The skip cache is not used.
+        :param frames: (N, H, W, 3) array or list of frames
+        :return: (N, H, W, 3) annotated frames, None when not rendering
+        """
+        frames = np.asarray(frames)
+        n, h = frames.shape[:2]
+        geometry = self.get_geometry(frames[0])
+        timer = self.timer
+        scale = self.detection_scale
+        with timer.stage('batch'):
+            with timer.stage('batch_warp'):
+                w = frames.shape[2]
+                warped = np.empty((n, int(round(h * scale)), int(round(w * scale)), 3), dtype=frames.dtype)
+                for i in range(n):
+                    geometry.undistort_and_warp(frames[i], dst=warped[i], scale=scale)
+            with timer.stage('batch_threshold'):
+                masks = np.empty(warped.shape[:3], dtype=np.uint8)
+                roi = geometry.scaled_roi(scale) if self.threshold_roi else None
+                for i in range(n):
+                    masks[i] = self.threshold_engine.pipeline(warped[i], roi=roi)
+            with timer.stage('batch_lane_search'):
+                bases = histogram_img_search.find_bases_batch(masks)
+                found = []
+                last_good_lane = self.last_good_lane(h)
+                for i in range(n):
+                    lane = histogram_img_search.get_window_for_lane(
+                        masks[i], last_good_lane=last_good_lane, bases=bases[i], curvature=False, scale=scale)
+                    if lane_state.classify(lane[5], lane[6]) == lane_state.GOOD:
+                        last_good_lane = [lane[5], lane[6]]
+                    found.append(lane)
+            with timer.stage('batch_curvature'):
+                fits = histogram_img_search.fit_polynomials_batch(
+                    [lane[2] for lane in found] + [lane[4] for lane in found],
+                    [lane[1] for lane in found] + [lane[3] for lane in found], h).reshape(2, n, 3)
+                # Each lane at its own lowest pixel
+                y_eval = np.array([[lane_model.lane_bottom(lane[2 * side + 2], h) for lane in found]
+                                   for side in range(2)])
+                curves = histogram_img_search.get_center_radius_from_fits(fits, y_eval)
+
+            out = np.empty_like(frames) if self.render else None
+            for i, lane in enumerate(found):
+                polys, leftx, lefty, rightx, righty, leftx_base, rightx_base = lane[:7]
+                frame_fits = (fits[0, i], fits[1, i])
+                trusted = histogram_img_search.is_confident(leftx, rightx, leftx_base, rightx_base, scale=scale)
+                if trusted:
+                    self.left_fit, self.right_fit = frame_fits
+                else:
+                    self.left_fit, self.right_fit = None, None
+                    self.history.reset_trusted()
+                self.lookahead_failures = 0
+                self.history.push(self.frame_num, (leftx_base, rightx_base), frame_fits,
+                                  windows=(lane[9], lane[10]), trusted=trusted)
+                with timer.stage('batch_draw'):
+                    undistorted = geometry.undistort(frames[i], roi_only=self.undistort_roi) if self.render else None
+                    out_img, center = self.draw(masks[i], undistorted, lane,
+                                                self.history.smoothed_fits() or frame_fits, geometry)
+                self.record_result(FULL, trusted, self.history.smoothed_fits() or frame_fits, curves[0, i],
+                                   curves[1, i], center, (leftx_base, rightx_base), windows=(lane[9], lane[10]))
+                if out is not None:
+                    self.annotate(out_img, curves[0, i], curves[1, i], center)
+                    out[i] = out_img
+                self.frame_num += 1
+        return out
+
+    def draw(self, thresh, undistorted, found, fits, geometry):
+        """
+        Lane overlay on the undistorted frame, reusing the detection fits
+        :param thresh:
+        :param undistorted:
+        :param found: get_window_for_lane tuple
+        :param fits: (left_fit, right_fit) or None to fit the found pixels
+        :param geometry:
+        :return: out_img, center; out_img is None when not rendering
+        """
+        if not self.render:
+            if fits is None and found is not None:
+                fits = self.fit_lanes(found)
+            return None, draw_lanes.center_offset(fits[0], fits[1]) if fits is not None else np.nan
+        with self.timer.stage('draw'):
+            if self.render_mode == 'fast' and fits is not None:
+                self.last_polygon = draw_lanes.lane_polygon(fits[0], fits[1], geometry)
+                return draw_lanes.draw_polygon(undistorted, self.last_polygon), \
+                    draw_lanes.center_offset(fits[0], fits[1])
+            self.last_polygon = None
+            leftx, lefty, rightx, righty = found[1:5] if found is not None else (None, None, None, None)
+            # draw_on_orig only takes the canvas size from its binary_warped argument, which must be full resolution
+            canvas = thresh if thresh is not None and thresh.shape == undistorted.shape[:2] else undistorted[:, :, 0]
+            return draw_lanes.draw_on_orig(canvas, undistorted, leftx, lefty, rightx, righty, geometry=geometry,
+                                           fits=fits)
+
+    def replay(self, undistorted, geometry):
+        """
+        Skip cache hit: the last processed frame's lanes and overlay polygon,
+        only blended onto this frame. Tracking state and history are left as they are.
+        :param undistorted:
+        :param geometry:
+        :return: out_img, None when not rendering
+        """
+        result = self.last_result = dict(self.last_result, frame=self.frame_num, mode=SKIP)
+        out_img = None
+        if self.render and self.last_polygon is not None:
+            with self.timer.stage('draw'):
+                out_img = draw_lanes.draw_polygon(undistorted, self.last_polygon)
+        elif self.render:
+            fits = (np.array(result['left_fit']), np.array(result['right_fit']))
+            out_img, _ = self.draw(None, undistorted, None, fits, geometry)
+        self.annotate(out_img, result['left_curve'], result['right_curve'], result['center'])
+        return out_img
+
+    def annotate(self, out_img, left_curve, right_curve, center):
+        """
+        Print curvature and center offset on the overlay, nothing when not rendering
+        :param out_img:
+        :param left_curve:
+        :param right_curve:
+        :param center:
+        :return:
+        """
+        if out_img is None:
+            return
+        with self.timer.stage('text'):
+            self.put_text(out_img, self.stats_text(left_curve, right_curve, center))
+
+    def record_result(self, mode, trusted, fits, left_curve, right_curve, center, bases, windows=None):
+        """
+        Keep the frame's lane geometry as plain Python values in last_result,
+        see results.ResultsWriter for the on-disk form
+        :param mode:
+        :param trusted:
+        :param fits: drawn (left_fit, right_fit) or None
+        :param left_curve:
+        :param right_curve:
+        :param center: offset from the lane center in pixels
+        :param bases:
+        :param windows: (left, right) sliding window centers, None when there was no search
+        :return:
+        """
+        self.last_result = {'frame': self.frame_num,
+                            'mode': mode,
+                            'trusted': bool(trusted),
+                            'left_fit': None if fits is None else [float(c) for c in fits[0]],
+                            'right_fit': None if fits is None else [float(c) for c in fits[1]],
+                            'left_curve': float(left_curve),
+                            'right_curve': float(right_curve),
+                            'center': float(center),
+                            'center_m': float(center * histogram_img_search.xm_per_pix),
+                            'leftx_base': int(bases[0]),
+                            'rightx_base': int(bases[1]),
+                            'left_windows': [] if windows is None else [float(x) for x in windows[0]],
+                            'right_windows': [] if windows is None else [float(x) for x in windows[1]]}
+        return self.last_result
+
+    def stats_text(self, left_curve, right_curve, center):
+        """
+        Overlay text, '-' for a curvature or offset without a fit (e.g. an empty lane)
+        """
+        curve = (left_curve + right_curve) / 2
+        return 'Curvature: {0}, Dist From Center: {1}, Frame: {2}'.format(
+            int(curve) if np.isfinite(curve) else '-',
+            round(center*3.7/700,1) if np.isfinite(center) else '-', self.frame_num)
+
+    @staticmethod
+    def put_text(out_img, stats_text):
         text_offset = 50
         text_shift = 1
         font = cv2.FONT_HERSHEY_SIMPLEX
         cv2.putText(out_img, stats_text, \
-                    (text_offset + text_shift, undistorted.shape[0] - text_offset + text_shift), \
+                    (text_offset + text_shift, out_img.shape[0] - text_offset + text_shift), \
                     font, 1, (0, 0, 0), 2)
-        cv2.putText(out_img, stats_text, (text_offset, undistorted.shape[0] - text_offset), \
+        cv2.putText(out_img, stats_text, (text_offset, out_img.shape[0] - text_offset), \
                     font, 1, (255, 255, 255), 2)
-        self.frame_num += 1
-        if self.save_pipeline:
-            cv2.imwrite('out_img.png', out_img)
-        if 1010 > self.frame_num > 975:
-            cv2.imwrite('bad_images/bad_frame_{0}.png'.format(self.frame_num), img)
-        return out_img
 
 
-def vid_pipe(path='project_video.mp4'):
+def vid_pipe(path='project_video.mp4', profile_report=None):
     from moviepy.editor import VideoFileClip
     clip = VideoFileClip(path)
-    p = Pipeline()
+    p = Pipeline(profile=profile_report is not None)
     output = clip.fl_image(p.main)
     output.write_videofile('project_video_annotated.mp4', audio=False)
+    if profile_report:
+        p.timer.export(profile_report)
     return p
 
 
@@ -1,22 +1,282 @@
+import hashlib
+import os
+
 import cv2
 import numpy as np
 import math
 import config
+import live_config
+
+# Geometry is identical for every frame of a stream, so it is built once per
+# (frame size, calibration, perspective configs) and reused.
+#
+# With startup_configs['geometry_cache'] set, the remap tables are also kept on
+# disk, keyed by a hash of the frame size, calibration and perspective config
+# values, and memory mapped by later processes instead of being rebuilt.
+_matrix_cache = {}
+_geometry_cache = {}
+_max_cache_entries = 8
 
 
 def get_warped_perspective(img, reverse_persp=False):
     w = img.shape[1]
     h = img.shape[0]
-    src = get_src(w, h)
-    dest = get_dest(w, h)
+    matrix, inv_matrix = get_perspective_matrices(w, h)
     if reverse_persp:
-        matrix = cv2.getPerspectiveTransform(dest, src)
-    else:
-        matrix = cv2.getPerspectiveTransform(src, dest)
+        matrix = inv_matrix
     flipped = img.shape[0:2][::-1]
     return cv2.warpPerspective(img, matrix, flipped)
 
 
+def get_perspective_matrices(w, h):
+    """
+    Forward (camera -> birds-eye) and inverse perspective matrices,
+    cached per frame size and perspective config
+    :param w:
+    :param h:
+    :return: matrix, inv_matrix
+    """
+    key = (w, h, _perspect_key())
+    matrices = _matrix_cache.get(key)
+    if matrices is None:
+        src = get_src(w, h)
+        dest = get_dest(w, h)
+        matrices = (cv2.getPerspectiveTransform(src, dest), cv2.getPerspectiveTransform(dest, src))
+        _store(_matrix_cache, key, matrices)
+    return matrices
+
+
+def get_geometry(w, h, mtx=None, dist=None):
+    """
+    Cached Geometry for a frame size and camera calibration
+    :param w:
+    :param h:
+    :param mtx: camera matrix, defaults to config.mtx
+    :param dist: distortion coefficients, defaults to config.dist
+    :return: Geometry
+    """
+    mtx = config.mtx if mtx is None else mtx
+    dist = config.dist if dist is None else dist
+    key = (w, h, _array_key(mtx), _array_key(dist), _perspect_key())
+    geometry = _geometry_cache.get(key)
+    if geometry is None:
+        geometry = _load_geometry(w, h, mtx, dist)
+        _store(_geometry_cache, key, geometry)
+    return geometry
+
+
+def _load_geometry(w, h, mtx, dist):
+    """
+    Geometry with its remap tables from the disk cache, built and saved on a miss
+    """
+    directory = config.startup_configs['geometry_cache']
+    if not directory:
+        return Geometry(w, h, mtx, dist)
+    path = os.path.join(directory, geometry_key(w, h, mtx, dist) + '.npy')
+    if os.path.exists(path):
+        maps = np.load(path, mmap_mode='r')
+        if maps.shape == (4, h, w):
+            return Geometry(w, h, mtx, dist, maps=maps)
+    geometry = Geometry(w, h, mtx, dist)
+    geometry.save_maps(path)
+    return geometry
+
+
+def geometry_key(w, h, mtx=None, dist=None):
+    """
+    Hash of everything the remap tables depend on, stable across processes
+    unlike the perspective configs version
+    :param w:
+    :param h:
+    :param mtx: camera matrix, defaults to config.mtx
+    :param dist: distortion coefficients, defaults to config.dist
+    :return: hex digest
+    """
+    mtx = config.mtx if mtx is None else mtx
+    dist = config.dist if dist is None else dist
+    key = hashlib.sha1(repr((config.startup_configs['version'], w, h,
+                             sorted(config.perspect_configs.items()))).encode())
+    for arr in (mtx, dist):
+        key.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+    return key.hexdigest()
+
+
+class Geometry(object):
+    def __init__(self, w, h, mtx, dist, maps=None):
+        """
+        Per-stream lookup tables: the perspective matrices, the undistort
+        maps and a single remap table that undistorts and warps to the
+        birds-eye view in one pass
+        :param w:
+        :param h:
+        :param mtx:
+        :param dist:
+        :param maps: (4, h, w) float32 undistort x, y and warp x, y tables saved by save_maps,
+                     built from mtx and dist when None
+        """
+        self.size = (w, h)
+        self.config_key = _perspect_key()
+        self.src = get_src(w, h)
+        self.dest = get_dest(w, h)
+        self.matrix, self.inv_matrix = get_perspective_matrices(w, h)
+        self.roi = get_roi(w, h)
+        self.undistort_roi = self._road_bbox()
+        if maps is None:
+            self.undistort_maps = cv2.initUndistortRectifyMap(mtx, dist, None, mtx, (w, h), cv2.CV_32FC1)
+            self.warp_maps = self._compose_warp_maps()
+        else:
+            self.undistort_maps = (maps[0], maps[1])
+            self.warp_maps = (maps[2], maps[3])
+        self._scaled_warp_maps = {1.0: self.warp_maps}
+
+    def save_maps(self, path):
+        """
+        Write the full resolution remap tables for Geometry(maps=np.load(path, mmap_mode='r'))
+        :param path:
+        :return:
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # Write then rename, so a concurrent reader never maps a partial file
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, np.stack(tuple(self.undistort_maps) + tuple(self.warp_maps)).astype(np.float32))
+        os.replace(tmp, path)
+
+    def _road_bbox(self):
+        """
+        Bounding box (x0, y0, x1, y1) of the part of the camera view the
+        pipeline uses: the source trapezoid, extended to everything the
+        birds-eye frame (and so the lane overlay) can map back to
+        :return:
+        """
+        w, h = self.size
+        corners = np.float32([[[0, 0]], [[w - 1, 0]], [[0, h - 1]], [[w - 1, h - 1]]])
+        pts = np.vstack((self.src, cv2.perspectiveTransform(corners, self.inv_matrix).reshape(-1, 2)))
+        x0, y0 = np.floor(pts.min(axis=0)).astype(int)
+        x1, y1 = np.ceil(pts.max(axis=0)).astype(int) + 1
+        return max(int(x0), 0), max(int(y0), 0), min(int(x1), w), min(int(y1), h)
+
+    def _compose_warp_maps(self, scale=1.0):
+        """
+        For every birds-eye pixel, look up where it lands in the undistorted
+        image (inverse homography) and then where that lands in the raw frame
+        (undistort maps).
+        :param scale: size of the birds-eye view relative to the frame
+        :return: map_x, map_y
+        """
+        out_w, out_h = self.scaled_size(scale)
+        grid = np.mgrid[0:out_h, 0:out_w].astype(np.float32)
+        if scale != 1.0:
+            # Pixel centers of the scaled view in full resolution birds-eye coordinates
+            grid = (grid + 0.5) / scale - 0.5
+        dest_pts = np.dstack((grid[1], grid[0]))
+        undist_pts = cv2.perspectiveTransform(dest_pts, self.inv_matrix)
+        undist_x = np.ascontiguousarray(undist_pts[:, :, 0])
+        undist_y = np.ascontiguousarray(undist_pts[:, :, 1])
+        # Points that fall outside the frame map to -1 so the final remap fills them with black
+        map_x = cv2.remap(self.undistort_maps[0], undist_x, undist_y, cv2.INTER_LINEAR,
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=-1)
+        map_y = cv2.remap(self.undistort_maps[1], undist_x, undist_y, cv2.INTER_LINEAR,
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=-1)
+        return map_x, map_y
+
+    def undistort(self, img, dst=None, roi_only=False):
+        """
+        :param img:
+        :param dst:
+        :param roi_only: only undistort inside undistort_roi, the rest of the frame is copied as is
+        :return:
+        """
+        if not roi_only:
+            return cv2.remap(img, self.undistort_maps[0], self.undistort_maps[1], cv2.INTER_LINEAR, dst=dst)
+        x0, y0, x1, y1 = self.undistort_roi
+        if dst is None:
+            dst = img.copy()
+        else:
+            dst[...] = img
+        dst[y0:y1, x0:x1] = cv2.remap(img, self.undistort_maps[0][y0:y1, x0:x1],
+                                      self.undistort_maps[1][y0:y1, x0:x1], cv2.INTER_LINEAR)
+        return dst
+
+    def warp(self, img, reverse_persp=False):
+        matrix = self.inv_matrix if reverse_persp else self.matrix
+        return cv2.warpPerspective(img, matrix, self.size)
+
+    def undistort_and_warp(self, img, dst=None, scale=1.0):
+        """
+        Raw frame straight to the birds-eye view with one remap
+        :param img:
+        :param dst: optional output array
+        :param scale: e.g. 0.5 for a half resolution birds-eye view
+        :return:
+        """
+        maps = self.scaled_warp_maps(scale)
+        return cv2.remap(img, maps[0], maps[1], cv2.INTER_LINEAR, dst=dst)
+
+    def scaled_warp_maps(self, scale):
+        """
+        Composed undistort + warp remap table of a scaled birds-eye view, built on first use
+        :param scale:
+        :return: map_x, map_y
+        """
+        maps = self._scaled_warp_maps.get(scale)
+        if maps is None:
+            maps = self._scaled_warp_maps[scale] = self._compose_warp_maps(scale)
+        return maps
+
+    def scaled_size(self, scale):
+        """
+        :param scale:
+        :return: (width, height) of a birds-eye view at scale
+        """
+        w, h = self.size
+        return int(round(w * scale)), int(round(h * scale))
+
+    def scaled_roi(self, scale):
+        """
+        roi in the coordinates of a scaled birds-eye view
+        :param scale:
+        :return:
+        """
+        if scale == 1.0:
+            return self.roi
+        x0, y0, x1, y1 = self.roi
+        out_w, out_h = self.scaled_size(scale)
+        return (int(x0 * scale), int(y0 * scale), min(int(np.ceil(x1 * scale)), out_w),
+                min(int(np.ceil(y1 * scale)), out_h))
+
+
+def _perspect_key():
+    return live_config.key('perspect_configs')
+
+
+def _array_key(arr):
+    arr = np.ascontiguousarray(arr, dtype=np.float64)
+    return arr.shape, arr.tobytes()
+
+
+def _store(cache, key, value):
+    if len(cache) >= _max_cache_entries:
+        cache.clear()
+    cache[key] = value
+
+
+def get_roi(w, h):
+    """
+    Bounding box (x0, y0, x1, y1) of the destination quadrangle,
+    the part of the birds-eye view the perspective configs keep
+    :param w:
+    :param h:
+    :return:
+    """
+    dest = get_dest(w, h)
+    x0, y0 = np.floor(dest.min(axis=0)).astype(int)
+    x1, y1 = np.ceil(dest.max(axis=0)).astype(int)
+    return max(int(x0), 0), max(int(y0), 0), min(int(x1), w), min(int(y1), h)
+
+
 def get_src(w, h):
     """
     Coordinates of quadrangle vertices in the source image.
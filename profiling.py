@@ -0,0 +1,129 @@
+import contextlib
+import csv
+import json
+import time
+
+import numpy as np
+
+import config
+
+
+# Per-stage latency tracking for Pipeline.
+# A disabled StageTimer hands out one shared no-op context manager, so the
+# instrumented code costs a method call and a `with` per stage.
+
+_NULL_STAGE = contextlib.nullcontext()
+
+
+class StageTimer(object):
+    def __init__(self, enabled=False, window=None):
+        """
+        Rolling latency samples per stage
+        :param enabled:
+        :param window: samples kept per stage for the percentiles
+        """
+        self.enabled = enabled
+        self.window = window or config.profile_configs['window']
+        self._samples = {}
+        self._counts = {}
+        self._totals = {}
+        self._first_start = None
+        self._last_end = None
+
+    def stage(self, name):
+        """
+        Context manager timing one stage of one frame
+        :param name:
+        :return:
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def record(self, name, start, end):
+        ring = self._samples.get(name)
+        if ring is None:
+            ring = self._samples[name] = np.zeros(self.window)
+            self._counts[name] = 0
+            self._totals[name] = 0.
+        seconds = end - start
+        ring[self._counts[name] % self.window] = seconds
+        self._counts[name] += 1
+        self._totals[name] += seconds
+        if name == 'frame':
+            if self._first_start is None:
+                self._first_start = start
+            self._last_end = end
+
+    def stats(self, name):
+        """
+        Count, mean and rolling p50/p95/p99 of a stage, in milliseconds
+        :param name:
+        :return:
+        """
+        count = self._counts[name]
+        samples = self._samples[name][:min(count, self.window)] * 1000
+        p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+        return {'count': count,
+                'mean_ms': self._totals[name] * 1000 / count,
+                'p50_ms': p50,
+                'p95_ms': p95,
+                'p99_ms': p99}
+
+    def summary(self):
+        """
+        :return: dict with per stage stats and frames per second
+        """
+        stages = dict((name, self.stats(name)) for name in self._samples)
+        frames = self._counts.get('frame', 0)
+        summary = {'frames': frames, 'stages': stages, 'fps': None, 'pipeline_fps': None}
+        if frames:
+            # fps over wall time between frames, pipeline_fps over time spent inside Pipeline.main
+            wall = self._last_end - self._first_start
+            summary['fps'] = frames / wall if wall > 0 else None
+            summary['pipeline_fps'] = frames / self._totals['frame']
+        return summary
+
+    def export_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def export_csv(self, path):
+        summary = self.summary()
+        columns = ['count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms']
+        with open(path, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['stage'] + columns)
+            for name, stats in sorted(summary['stages'].items()):
+                writer.writerow([name] + [stats[c] for c in columns])
+            writer.writerow(['fps', summary['fps']])
+
+    def export(self, path):
+        """
+        Write the report as CSV when path ends with .csv, JSON otherwise
+        :param path:
+        :return:
+        """
+        if path.endswith('.csv'):
+            self.export_csv(path)
+        else:
+            self.export_json(path)
+
+
+class _Stage(object):
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.record(self.name, self.start, time.perf_counter())
+        return False
+
+
+disabled = StageTimer(enabled=False)
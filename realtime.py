@@ -0,0 +1,211 @@
+import argparse
+import queue
+import threading
+import time
+
+import numpy as np
+
+import config
+import main
+import stream
+
+
+# Real-time driver for live feeds. Every frame gets a deadline (capture time +
+# budget). Before processing, the driver picks the most accurate Pipeline mode
+# whose recent latency still fits in the time left: full detection, look-ahead
+# only (no histogram search), or reusing the tracked fits. A frame that cannot
+# make it in any mode is dropped, and when frames arrive faster than they are
+# processed the oldest waiting frame is dropped. After max_reuse reused frames in
+# a row the next frame runs detection anyway, so the tracked lanes and the
+# latency estimates do not go stale, and after max_drops frames dropped in a row
+# the next frame runs full detection, which also refreshes its estimate. Once
+# max_lookahead_failures look-ahead frames in a row lost the lanes, the next
+# frame runs full detection too, whatever its estimate: the look-ahead cannot
+# find them again. A frame that raises is counted as an error and skipped, the
+# feed goes on. A capture source that raises ends the feed with its error.
+
+MODES = (main.FULL, main.LOOKAHEAD, main.REUSE)
+
+
+class RealtimeDriver(object):
+    def __init__(self, pipeline=None, budget_ms=None, max_queue=None):
+        """
+        :param pipeline: defaults to a new Pipeline
+        :param budget_ms: per-frame latency budget, from capture to output
+        :param max_queue: frames waiting to be processed before the oldest is dropped
+        """
+        self.pipeline = pipeline or main.Pipeline()
+        self.budget = (budget_ms or config.realtime_configs['budget_ms']) / 1000.
+        self.max_queue = max_queue or config.realtime_configs['max_queue']
+        # Exponentially weighted latency per mode, unknown modes are assumed to fit
+        self.estimates = dict((mode, 0.) for mode in MODES)
+        self.counts = dict((mode, 0) for mode in MODES)
+        # Frames each estimate was measured on, setup frames are not
+        self.samples = dict((mode, 0) for mode in MODES)
+        self.reuse_streak = 0
+        self.drop_streak = 0
+        self.dropped_deadline = 0
+        self.errors = 0
+        self.last_error = None
+        self.dropped_backpressure = 0
+        self.missed_deadline = 0
+        self.latencies = []
+
+    def choose_mode(self, remaining):
+        """
+        Most accurate mode expected to finish in the remaining time
+        :param remaining: seconds left before the frame's deadline
+        :return: a Pipeline mode, or None to drop the frame
+        """
+        if self.drop_streak >= config.realtime_configs['max_drops']:
+            # The estimates only change when their mode runs, so a FULL estimate
+            # that no longer fits would otherwise drop every frame from now on
+            return main.FULL
+        if self.pipeline.lookahead_failures >= config.hist_configs['max_lookahead_failures']:
+            # Only the full search finds lost lanes again, a faster mode would keep them lost
+            return main.FULL
+        tracking = self.pipeline.left_fit is not None
+        for mode in MODES:
+            if mode != main.FULL and not tracking:
+                break
+            if self.estimates[mode] <= remaining:
+                if mode == main.REUSE and self.reuse_streak >= config.realtime_configs['max_reuse']:
+                    return main.LOOKAHEAD
+                return mode
+        return None
+
+    def process(self, frame, captured_at=None):
+        """
+        Process one frame against its deadline
+        :param frame: RGB frame
+        :param captured_at: time.perf_counter() when the frame was captured, defaults to now
+        :return: annotated frame, or None when it was dropped or failed
+        """
+        captured_at = time.perf_counter() if captured_at is None else captured_at
+        deadline = captured_at + self.budget
+        start = time.perf_counter()
+        mode = self.choose_mode(deadline - start)
+        if mode is None:
+            self.dropped_deadline += 1
+            self.drop_streak += 1
+            return None
+        self.drop_streak = 0
+        geometry = self.pipeline.geometry
+        try:
+            out = self.pipeline.main(frame, mode=mode)
+        except Exception as e:
+            # One bad frame costs that frame, not the feed
+            self.errors += 1
+            self.last_error = '{0}: {1}'.format(type(e).__name__, e)
+            return None
+        end = time.perf_counter()
+        elapsed = end - start
+        # A frame that built the remap tables is not what the mode costs from now on
+        if self.pipeline.geometry is geometry:
+            alpha = config.realtime_configs['smoothing']
+            self.estimates[mode] = elapsed if not self.samples[mode] else \
+                alpha * elapsed + (1 - alpha) * self.estimates[mode]
+            self.samples[mode] += 1
+        self.counts[mode] += 1
+        self.reuse_streak = self.reuse_streak + 1 if mode == main.REUSE else 0
+        if end > deadline:
+            self.missed_deadline += 1
+        self.latencies.append(end - captured_at)
+        del self.latencies[:-config.profile_configs['window']]
+        return out
+
+    def run(self, frames):
+        """
+        Capture on its own thread and process as fast as the budget allows
+        :param frames: live iterable of RGB frames, e.g. stream.video_source(0)
+        :return: generator of annotated frames, dropped frames are skipped; an error of
+                 the capture source is raised once the frames before it are processed
+        """
+        pending = queue.Queue(maxsize=self.max_queue)
+        done = object()
+        stop = threading.Event()
+
+        def put(item):
+            # Never blocks: a full queue drops its oldest frame
+            while True:
+                try:
+                    pending.put_nowait(item)
+                    return
+                except queue.Full:
+                    try:
+                        pending.get_nowait()
+                        self.dropped_backpressure += 1
+                    except queue.Empty:
+                        pass
+
+        def capture():
+            try:
+                for frame in frames:
+                    if stop.is_set():
+                        return
+                    put((frame, time.perf_counter()))
+            except Exception as e:
+                # Blocking puts, a drop-oldest put could drop the error itself
+                stream._put(pending, stream._Failure(e), stop)
+            finally:
+                stream._put(pending, done, stop)
+
+        thread = threading.Thread(target=capture)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item = pending.get()
+                if item is done:
+                    break
+                if isinstance(item, stream._Failure):
+                    raise item.error
+                out = self.process(*item)
+                if out is not None:
+                    yield out
+        finally:
+            stop.set()
+
+    def stats(self):
+        """
+        :return: dict of frames per mode, dropped and late frames, and output latency percentiles
+        """
+        processed = sum(self.counts.values())
+        stats = {'processed': processed,
+                 'full': self.counts[main.FULL],
+                 'degraded': processed - self.counts[main.FULL],
+                 'lookahead': self.counts[main.LOOKAHEAD],
+                 'reused': self.counts[main.REUSE],
+                 'dropped_deadline': self.dropped_deadline,
+                 'dropped_backpressure': self.dropped_backpressure,
+                 'missed_deadline': self.missed_deadline,
+                 'errors': self.errors,
+                 'last_error': self.last_error,
+                 'estimates_ms': dict((mode, est * 1000) for mode, est in self.estimates.items())}
+        if self.pipeline.skip_cache is not None:
+            stats['skip_cache'] = self.pipeline.skip_cache.stats()
+        if self.latencies:
+            p50, p95, p99 = np.percentile(np.array(self.latencies) * 1000, [50, 95, 99])
+            stats.update({'latency_p50_ms': float(p50), 'latency_p95_ms': float(p95), 'latency_p99_ms': float(p99)})
+        return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Annotate a live feed under a per-frame latency budget')
+    parser.add_argument('source', help='camera index or video file')
+    parser.add_argument('--out', help='output video file')
+    parser.add_argument('--budget-ms', type=float, default=None)
+    parser.add_argument('--config', help='JSON config overrides, reloaded while running when the file changes')
+    args = parser.parse_args()
+    if args.config:
+        import live_config
+        live_config.load(args.config)
+    source = int(args.source) if args.source.isdigit() else args.source
+    driver = RealtimeDriver(budget_ms=args.budget_ms)
+    annotated = driver.run(stream.video_source(source))
+    if args.out:
+        stream.video_sink(args.out)(annotated)
+    else:
+        for _ in annotated:
+            pass
+    print(driver.stats())
@@ -0,0 +1,54 @@
+import collections
+
+import config
+
+
+class ResolutionController(object):
+    def __init__(self, scales=None, target_fps=None, patience=None):
+        """
+        Picks the detection scale frame by frame: steps down to a smaller
+        birds-eye view when frames take longer than the target frame rate
+        allows, and back up when detection confidence falls.
+        :param scales: detection scales, largest first
+        :param target_fps:
+        :param patience: frames to observe between two changes
+        """
+        self.scales = sorted(scales or config.resolution_configs['scales'], reverse=True)
+        self.target_fps = target_fps or config.resolution_configs['target_fps']
+        self.patience = patience or config.resolution_configs['patience']
+        self.level = self.scales.index(config.resolution_configs['scale']) \
+            if config.resolution_configs['scale'] in self.scales else 0
+        self.latencies = collections.deque(maxlen=self.patience)
+        self.unconfident = 0
+        self.since_change = 0
+        self.changes = []
+
+    @property
+    def scale(self):
+        return self.scales[self.level]
+
+    def update(self, frame_seconds, confident):
+        """
+        Record one frame and maybe change the scale for the next one
+        :param frame_seconds: time the frame took
+        :param confident: whether detection passed the confidence check
+        :return: the scale for the next frame
+        """
+        self.latencies.append(frame_seconds)
+        self.unconfident = 0 if confident else self.unconfident + 1
+        self.since_change += 1
+        if self.since_change < self.patience:
+            return self.scale
+        budget = 1. / self.target_fps
+        if self.unconfident >= self.patience and self.level > 0:
+            self._change(self.level - 1, 'confidence')
+        elif sum(self.latencies) / len(self.latencies) > budget and self.level < len(self.scales) - 1:
+            self._change(self.level + 1, 'latency')
+        return self.scale
+
+    def _change(self, level, reason):
+        self.changes.append((self.scales[self.level], self.scales[level], reason))
+        self.level = level
+        self.since_change = 0
+        self.unconfident = 0
+        self.latencies.clear()
@@ -0,0 +1,135 @@
+import struct
+
+import numpy as np
+
+import config
+
+
+# Per-frame lane geometry as a columnar table: one row per frame in a .npy
+# file of a structured dtype. Rows are buffered and written in bulk, the header
+# is rewritten with the row count after every write, so the file is a valid
+# .npy (np.load, mmap_mode) at any point of a run.
+
+MODES = ('full', 'lookahead', 'reuse', 'skip')
+
+
+def result_dtype(nwindows=None):
+    """
+    Row layout. Missing fits and window centers are NaN, mode is an index into MODES.
+    The window centers are the base followed by one center per sliding window.
+    :param nwindows: sliding windows per lane, defaults to hist_configs['nwindows']
+    :return:
+    """
+    centers = (nwindows or config.hist_configs['nwindows']) + 1
+    return np.dtype([('frame', '<i8'),
+                     ('mode', 'u1'),
+                     ('trusted', '?'),
+                     ('left_fit', '<f8', (3,)),
+                     ('right_fit', '<f8', (3,)),
+                     ('left_curve', '<f8'),
+                     ('right_curve', '<f8'),
+                     ('center', '<f8'),
+                     ('center_m', '<f8'),
+                     ('leftx_base', '<i4'),
+                     ('rightx_base', '<i4'),
+                     ('left_windows', '<f4', (centers,)),
+                     ('right_windows', '<f4', (centers,))])
+
+
+def to_row(row, result):
+    """
+    Fill a result_dtype row from a Pipeline.last_result dict
+    :param row: np.void of result_dtype, e.g. buffer[i]
+    :param result:
+    :return:
+    """
+    row['frame'] = result['frame']
+    row['mode'] = MODES.index(result['mode'])
+    row['trusted'] = result['trusted']
+    for name in ('left_fit', 'right_fit'):
+        row[name] = np.nan if result[name] is None else result[name]
+    for name in ('left_curve', 'right_curve', 'center', 'center_m', 'leftx_base', 'rightx_base'):
+        row[name] = result[name]
+    for name in ('left_windows', 'right_windows'):
+        windows = result[name][:len(row[name])]
+        row[name] = np.nan
+        row[name][:len(windows)] = windows
+    return row
+
+
+def npy_header(dtype, rows, item_shape=()):
+    """
+    .npy version 1.0 header with a fixed width row count, so it can be rewritten in place
+    :param dtype:
+    :param rows:
+    :param item_shape: shape of every row, e.g. (h, w, 3) for frames
+    :return: bytes
+    """
+    shape = ''.join(' {0},'.format(n) for n in item_shape)
+    header = "{{'descr': {0!r}, 'fortran_order': False, 'shape': ({1:20d},{2}), }}".format(
+        np.lib.format.dtype_to_descr(dtype), rows, shape)
+    # magic (6) + version (2) + header length (2) + header + newline, padded to 64 bytes
+    pad = -(10 + len(header) + 1) % 64
+    return (np.lib.format.magic(1, 0) + struct.pack('<H', len(header) + pad + 1) +
+            header.encode('latin1') + b' ' * pad + b'\n')
+
+
+class ResultsWriter(object):
+    def __init__(self, path, nwindows=None, buffer_rows=None):
+        """
+        Append-only .npy of result_dtype rows
+        :param path:
+        :param nwindows:
+        :param buffer_rows: rows per bulk write, defaults to results_configs['buffer_rows']
+        """
+        self.path = path
+        self.dtype = result_dtype(nwindows)
+        self.buffer = np.zeros(buffer_rows or config.results_configs['buffer_rows'], dtype=self.dtype)
+        self.buffered = 0
+        self.rows = 0
+        self.file = open(path, 'wb')
+        self.file.write(npy_header(self.dtype, 0))
+
+    def append(self, result):
+        """
+        :param result: Pipeline.last_result
+        :return:
+        """
+        to_row(self.buffer[self.buffered], result)
+        self.buffered += 1
+        if self.buffered == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        if not self.buffered:
+            return
+        self.file.write(self.buffer[:self.buffered].tobytes())
+        self.rows += self.buffered
+        self.buffered = 0
+        end = self.file.tell()
+        self.file.seek(0)
+        self.file.write(npy_header(self.dtype, self.rows))
+        self.file.seek(end)
+        self.file.flush()
+
+    def close(self):
+        if self.file is None:
+            return
+        self.flush()
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_results(path, mmap=True):
+    """
+    :param path: file written by ResultsWriter
+    :param mmap: map the file instead of reading it
+    :return: structured array of result_dtype rows
+    """
+    return np.load(path, mmap_mode='r' if mmap else None)
@@ -0,0 +1,331 @@
+import argparse
+import glob
+import os
+import queue
+import sys
+import threading
+
+import cv2
+import numpy as np
+
+import config
+
+
+# Streaming frame sources and sinks. Every source is a generator of RGB frames
+# (the order moviepy hands to Pipeline.main) and every sink consumes RGB frames,
+# so nothing ever holds more than a few frames of a stream in memory.
+
+def video_source(path):
+    """
+    Frames from a video file, or from a live camera when path is a device index
+    :param path: file path, URL or camera index
+    :return:
+    """
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise IOError('Could not open video source {0}'.format(path))
+    try:
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    finally:
+        cap.release()
+
+
+def image_dir_source(directory, pattern='*.jpg'):
+    """
+    Frames from the images in a directory, in sorted file name order
+    :param directory:
+    :param pattern:
+    :return:
+    """
+    for path in sorted(glob.glob(os.path.join(directory, pattern))):
+        img = cv2.imread(path)
+        if img is None:
+            raise IOError('Could not read image {0}'.format(path))
+        yield cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def raw_source(width, height, stream=None):
+    """
+    Raw rgb24 frames from a byte stream, stdin by default.
+    e.g. ffmpeg -i in.mp4 -f rawvideo -pix_fmt rgb24 - | python stream.py --raw 1280x720 ...
+    :param width:
+    :param height:
+    :param stream:
+    :return:
+    """
+    stream = stream or sys.stdin.buffer
+    frame_bytes = width * height * 3
+    while True:
+        buf = stream.read(frame_bytes)
+        if len(buf) < frame_bytes:
+            break
+        yield np.frombuffer(buf, dtype=np.uint8).reshape((height, width, 3))
+
+
+def video_sink(path, fps=None):
+    """
+    Sink writing frames to a video file
+    :param path:
+    :param fps:
+    :return: function taking an iterable of frames
+    """
+    fps = fps or config.video_configs['fps']
+
+    def write(frames):
+        writer = None
+        try:
+            for frame in frames:
+                if writer is None:
+                    h, w = frame.shape[:2]
+                    fourcc = cv2.VideoWriter_fourcc(*config.video_configs['fourcc'])
+                    writer = cv2.VideoWriter(path, fourcc, fps, (w, h))
+                writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+        finally:
+            if writer is not None:
+                writer.release()
+    return write
+
+
+def image_dir_sink(directory, pattern='frame_{0:06d}.png'):
+    """
+    Sink writing one image per frame
+    :param directory:
+    :param pattern:
+    :return: function taking an iterable of frames
+    """
+    def write(frames):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        for i, frame in enumerate(frames):
+            cv2.imwrite(os.path.join(directory, pattern.format(i)), cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+    return write
+
+
+def raw_sink(stream=None):
+    """
+    Sink writing raw rgb24 frames to a byte stream, stdout by default
+    :param stream: defaults to stdout, which the sink then owns: sys.stdout becomes
+                   stderr, so text printed while streaming cannot land between frames
+    :return: function taking an iterable of frames
+    """
+    if stream is None:
+        sys.stdout.flush()
+        stream = sys.stdout.buffer
+        sys.stdout = sys.stderr
+
+    def write(frames):
+        for frame in frames:
+            stream.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+        stream.flush()
+    return write
+
+
+_DONE = object()
+
+
+class _Failure(object):
+    def __init__(self, error):
+        self.error = error
+
+
+def _put(q, item, stop):
+    """Blocking put that gives up once the stream is stopped"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _feed(frames, out_q, stop):
+    try:
+        for frame in frames:
+            if not _put(out_q, frame, stop):
+                return
+    except Exception as e:
+        _put(out_q, _Failure(e), stop)
+    _put(out_q, _DONE, stop)
+
+
+def _map(process, in_q, out_q, stop):
+    while True:
+        item = in_q.get()
+        if item is _DONE or isinstance(item, _Failure):
+            _put(out_q, item, stop)
+            return
+        try:
+            result = process(item)
+        except Exception as e:
+            _put(out_q, _Failure(e), stop)
+            return
+        if not _put(out_q, result, stop):
+            return
+
+
+def _drain(q):
+    while True:
+        item = q.get()
+        if item is _DONE:
+            return
+        if isinstance(item, _Failure):
+            raise item.error
+        yield item
+
+
+def process_stream(frames, process=None, queue_size=None):
+    """
+    Decode and process on their own threads, connected by bounded queues,
+    yielding processed frames in order. A slow consumer blocks the stages
+    behind it instead of letting frames pile up.
+    :param frames: iterable of RGB frames, e.g. from video_source
+    :param process: per frame function, defaults to a new Pipeline().main
+    :param queue_size: frames buffered between two stages
+    :return: generator of processed frames
+    """
+    if process is None:
+        from main import Pipeline
+        process = Pipeline().main
+    queue_size = queue_size or config.video_configs['queue_size']
+    decoded = queue.Queue(maxsize=queue_size)
+    processed = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    threads = [threading.Thread(target=_feed, args=(frames, decoded, stop)),
+               threading.Thread(target=_map, args=(process, decoded, processed, stop))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        for item in _drain(processed):
+            yield item
+    finally:
+        stop.set()
+        # Unblock the processing thread if it is waiting on an empty queue
+        _put_nowait(decoded, _DONE)
+        for t in threads:
+            t.join()
+
+
+def _put_nowait(q, item):
+    try:
+        q.put_nowait(item)
+    except queue.Full:
+        pass
+
+
+def run(frames, sink, process=None, queue_size=None):
+    """
+    Full decode -> process -> encode stream, with the sink on a third thread
+    :param frames: iterable of RGB frames
+    :param sink: e.g. video_sink('out.mp4')
+    :param process:
+    :param queue_size:
+    :return: number of frames written
+    """
+    queue_size = queue_size or config.video_configs['queue_size']
+    encoded = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    count = [0]
+
+    def counted():
+        for frame in process_stream(frames, process=process, queue_size=queue_size):
+            count[0] += 1
+            yield frame
+
+    feeder = threading.Thread(target=_feed, args=(counted(), encoded, stop))
+    feeder.daemon = True
+    feeder.start()
+    try:
+        sink(_drain(encoded))
+    finally:
+        stop.set()
+        feeder.join()
+    return count[0]
+
+
+def pipeline_process(pipeline, results=None):
+    """
+    Per frame function for process_stream and run that also keeps the lane geometry
+    :param pipeline: main.Pipeline
+    :param results: optional results.ResultsWriter, gets every frame's last_result in order
+    :return:
+    """
+    def process(frame):
+        out = pipeline.main(frame)
+        if results is not None:
+            results.append(pipeline.last_result)
+        return out
+    return process
+
+
+def parse_size(size):
+    width, height = size.lower().split('x')
+    return int(width), int(height)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Annotate a stream of frames with bounded memory')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--video', help='video file or URL')
+    source.add_argument('--camera', type=int, help='camera device index')
+    source.add_argument('--images', help='directory of images')
+    source.add_argument('--raw', metavar='WxH', help='raw rgb24 frames on stdin')
+    sink = parser.add_mutually_exclusive_group()
+    sink.add_argument('--out', help='output video file')
+    sink.add_argument('--out-dir', help='output directory of images')
+    sink.add_argument('--stdout', action='store_true', help='raw rgb24 frames on stdout')
+    parser.add_argument('--results', help='write per-frame lane geometry to this .npy file')
+    parser.add_argument('--no-render', action='store_true', help='skip drawing and encoding, needs --results')
+    parser.add_argument('--skip-static', action='store_true', help='reuse the lanes of near-duplicate frames')
+    parser.add_argument('--fps', type=float, default=None)
+    parser.add_argument('--queue-size', type=int, default=None)
+    parser.add_argument('--profile', metavar='REPORT', help='write per-stage latencies to a .json or .csv report')
+    parser.add_argument('--config', help='JSON config overrides, reloaded while running when the file changes')
+    args = parser.parse_args()
+    if args.no_render and not args.results:
+        parser.error('--no-render needs --results')
+    if not args.no_render and not (args.out or args.out_dir or args.stdout):
+        parser.error('one of --out --out-dir --stdout is required unless --no-render')
+
+    if args.video:
+        frames = video_source(args.video)
+    elif args.camera is not None:
+        frames = video_source(args.camera)
+    elif args.images:
+        frames = image_dir_source(args.images)
+    else:
+        frames = raw_source(*parse_size(args.raw))
+    if args.no_render:
+        write = None
+    elif args.out:
+        write = video_sink(args.out, fps=args.fps)
+    elif args.out_dir:
+        write = image_dir_sink(args.out_dir)
+    else:
+        write = raw_sink()
+    if args.config:
+        import live_config
+        live_config.load(args.config)
+    from main import Pipeline
+    from results import ResultsWriter
+    p = Pipeline(profile=args.profile is not None, render=not args.no_render, skip_static=args.skip_static or None)
+    results = ResultsWriter(args.results) if args.results else None
+    try:
+        process = pipeline_process(p, results)
+        if write is None:
+            n = sum(1 for _ in process_stream(frames, process=process, queue_size=args.queue_size))
+        else:
+            n = run(frames, write, process=process, queue_size=args.queue_size)
+    finally:
+        if results is not None:
+            results.close()
+    sys.stderr.write('{0} {1} frames\n'.format('Wrote' if write else 'Processed', n))
+    if p.skip_cache is not None:
+        sys.stderr.write('Skip cache: {0}\n'.format(p.skip_cache.stats()))
+    if args.profile:
+        p.timer.export(args.profile)
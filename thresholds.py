@@ -2,15 +2,29 @@ import cv2
 import numpy as np
 
 import config
+import live_config
 
 
 # Use color transforms, gradients, etc., to create a thresholded binary image.
 
-def pipeline(img):
+def pipeline(img, roi=None):
     """
     Pipeline for a combined threshold pipeline,
     thresholds found from testing different options
-    but also from guidance on slack
+    but also from guidance on slack.
+    Runs on the shared ThresholdEngine, the returned mask is
+    reused by the next call.
+    :param img:
+    :param roi: optional (x0, y0, x1, y1), only threshold inside it
+    :return:
+    """
+    return _engine.pipeline(img, roi=roi)
+
+
+def reference_pipeline(img):
+    """
+    Original float64 implementation of pipeline, kept to check the
+    ThresholdEngine against
     :param img:
     :return:
     """
@@ -67,3 +81,104 @@ def threshold(image, thresh_min, thresh_max):
     binary = np.zeros(image.shape, dtype=np.float32)
     binary[(image >= thresh_min) & (image <= thresh_max)] = 1
     return binary
+
+
+class ThresholdEngine(object):
+    def __init__(self):
+        """
+        Same mask as reference_pipeline, but computed in uint8/int16 into
+        buffers that are allocated once per frame size:
+        - Sobel runs at CV_16S (|dx| <= 4 * 255 for a 3x3 kernel on uint8)
+        - the 0-255 rescale by the max gradient is folded into integer
+          bounds on the raw gradient, so there is no float image at all
+        - every threshold is a cv2.inRange ORed into the one output mask
+        """
+        self._buffers = {}
+
+    def buffers(self, shape):
+        bufs = self._buffers.get(shape)
+        if bufs is None:
+            h, w = shape
+            bufs = {'hls': np.empty((h, w, 3), dtype=np.uint8),
+                    'grey': np.empty((h, w), dtype=np.uint8),
+                    's': np.empty((h, w), dtype=np.uint8),
+                    'r': np.empty((h, w), dtype=np.uint8),
+                    'sobel': np.empty((h, w), dtype=np.int16),
+                    'tmp': np.empty((h, w), dtype=np.uint8),
+                    'mask': np.empty((h, w), dtype=np.uint8)}
+            self._buffers[shape] = bufs
+        return bufs
+
+    def pipeline(self, img, roi=None):
+        """
+        :param img: RGB uint8 image
+        :param roi: optional (x0, y0, x1, y1), the mask is zero outside of it
+        :return: uint8 mask of 0/255, reused by the next call
+        """
+        if roi is None:
+            return self._threshold(img, self.buffers(img.shape[:2]))
+        x0, y0, x1, y1 = roi
+        out = self.buffers(img.shape[:2])['mask']
+        out.fill(0)
+        crop = img[y0:y1, x0:x1]
+        out[y0:y1, x0:x1] = self._threshold(crop, self.buffers(crop.shape[:2]))
+        return out
+
+    def _threshold(self, img, bufs):
+        mask, tmp, s_img = bufs['mask'], bufs['tmp'], bufs['s']
+        cv2.cvtColor(img, cv2.COLOR_RGB2HLS, dst=bufs['hls'])
+        cv2.extractChannel(bufs['hls'], 2, dst=s_img)
+        cv2.cvtColor(img, cv2.COLOR_RGB2GRAY, dst=bufs['grey'])
+        cv2.extractChannel(img, 0, dst=bufs['r'])
+
+        self._sobel_x(bufs['grey'], bufs['sobel'], mask)
+        self._sobel_x(s_img, bufs['sobel'], tmp)
+        cv2.bitwise_or(mask, tmp, dst=mask)
+        self._in_range(s_img, config.threshold_configs['s_img_min'], config.threshold_configs['s_img_max'], tmp)
+        cv2.bitwise_or(mask, tmp, dst=mask)
+        # rgb_binary_threshold_r: 200 < R <= 255
+        self._in_range(bufs['r'], 201, 255, tmp)
+        cv2.bitwise_or(mask, tmp, dst=mask)
+        return mask
+
+    @staticmethod
+    def _sobel_x(img, sobel, dst):
+        """
+        thresholded_sobel_x in integers, see sobel_bounds
+        """
+        cv2.Sobel(img, cv2.CV_16S, 1, 0, dst=sobel)
+        np.abs(sobel, out=sobel)
+        max_grad = int(sobel.max())
+        if max_grad == 0:
+            lo = config.threshold_configs['sobel_min']
+            hi = config.threshold_configs['sobel_max']
+            dst.fill(255 if lo <= 0 <= hi else 0)
+            return dst
+        grad_lo, grad_hi = sobel_bounds()
+        return cv2.inRange(sobel, int(grad_lo[max_grad]), int(grad_hi[max_grad]), dst=dst)
+
+    @staticmethod
+    def _in_range(img, thresh_min, thresh_max, dst):
+        if thresh_min > 255 or thresh_max < max(thresh_min, 0):
+            dst.fill(0)
+            return dst
+        return cv2.inRange(img, max(thresh_min, 0), min(thresh_max, 255), dst=dst)
+
+
+@live_config.derived('threshold_configs')
+def sobel_bounds():
+    """
+    floor(255 * a / max) in [lo, hi] is 255 * a >= lo * max and 255 * a < (hi + 1) * max,
+    so the gradient bounds only depend on the max gradient of the frame:
+    one lookup table entry for every max a 3x3 Sobel on uint8 can reach (4 * 255)
+    :return: grad_lo, grad_hi indexed by the max gradient
+    """
+    max_grad = np.arange(4 * 255 + 1, dtype=np.int64)
+    lo = config.threshold_configs['sobel_min']
+    hi = config.threshold_configs['sobel_max']
+    grad_lo = np.maximum(-(-lo * max_grad // 255), 0)
+    grad_hi = ((hi + 1) * max_grad - 1) // 255
+    return grad_lo, grad_hi
+
+
+_engine = ThresholdEngine()